@@ -10,6 +10,7 @@ setup(name='DirIndexer',
 	url='https://github.com/GGreenwood/DirIndexer',
     package_dir = {'': 'src'},
     packages = find_packages('src'),
+    py_modules = ['dirindexer'],
     scripts=['src/dirindexer.py'],
 	entry_points= {
 		'console_scripts': [
@@ -19,6 +20,7 @@ setup(name='DirIndexer',
 	install_requires=[
 		'Whoosh>=2.4.1',
 		'colorama>=0.2.5',
-		'watchdog>=0.6.0'
+		'watchdog>=0.6.0',
+		'scandir>=1.5'
 	]
 )
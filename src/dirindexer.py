@@ -1,20 +1,78 @@
-from whoosh.index import create_in
-from whoosh.index import open_dir
-from whoosh.fields import Schema, TEXT, ID, STORED
-from whoosh.analysis import SpaceSeparatedTokenizer, LowercaseFilter
-from whoosh.writing import BufferedWriter
-from whoosh import highlight
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-import watchdog.utils
+#whoosh, watchdog, colorama and multiprocessing are imported where they
+#are used, so each subcommand only loads what it needs: search answered
+#by a server or the query cache never imports whoosh at all
 import os
 import argparse
 import codecs
-import multiprocessing
 import threading
-import colorama
 import time
 import Queue
+import collections
+import cPickle
+import hashlib
+import json
+import socket
+import SocketServer
+import StringIO
+import sys
+import zlib
+import heapq
+import itertools
+import errno
+import signal
+import math
+import random
+import bisect
+import resource
+import shutil
+import copy
+import tempfile
+import contextlib
+import re
+import stat
+try:
+    import xxhash
+    HASH_NAME, new_hash = 'xxh64', xxhash.xxh64
+except ImportError:
+    if hasattr(hashlib, 'blake2b'):
+        HASH_NAME, new_hash = 'blake2b', hashlib.blake2b
+    else:
+        HASH_NAME, new_hash = 'sha1', hashlib.sha1
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        class DirEntry(object):
+            """Minimal os.DirEntry for Pythons without scandir, which
+            stats each entry once"""
+            def __init__(self, root, name):
+                self.name = name
+                self.path = os.path.join(root, name)
+                self.st = None
+
+            def is_dir(self):
+                try:
+                    return stat.S_ISDIR(self.stat().st_mode)
+                except EnvironmentError:
+                    return False
+
+            def stat(self):
+                if self.st is None:
+                    self.st = os.stat(self.path)
+                return self.st
+
+        def scandir(path):
+            """Minimal os.scandir for Pythons without scandir"""
+            return [DirEntry(path, name) for name in os.listdir(path)]
+
+#Name of the table of contents file of each generation of a whoosh index
+TOC_PATTERN = re.compile(r"^_MAIN_([0-9]+)[.]toc$")
+
+#Milliseconds a fresh process may take to print --help or to answer a
+#search from the query cache, as checked by bench
+STARTUP_BUDGET_MS = 150.0
 
 
 class DirIndexer:
@@ -31,9 +89,19 @@ class DirIndexer:
         args:   The namespace created by argparse containing several options
                 for each of dirindexer's modes
 
+            every mode but bench:
+                index_dir : str, optional
+                    The directory holding the index. Defaults to
+                    .indexdir in the working directory, or for update,
+                    daemon, search and serve in the nearest parent that
+                    has one
+
             index, update, daemon:
                 directory : str
-                    The directory to process.
+                    The directory to process. It is registered as a root
+                    of the index along with its exclude, include and all
+                    settings. Optional for update and daemon, which
+                    process every root of the index without it
                 exclude : list of str, optional
                     List of filetypes to exclude from the process.
                 include : list of str, optional
@@ -41,13 +109,90 @@ class DirIndexer:
                 processors : int, optional
                     Number of processor cores to use in the process,
                     defaults to 1/2 of cores available
+                readers : int, optional
+                    Number of threads reading files for the writer,
+                    defaults to the number of cores available
+                shards : int, optional
+                    index only. Number of shards to split a new index
+                    into, each written by its own process. Defaults to
+                    the number the index already has, or 1
                 all : bool, default=false, optional
                     Whether to include hidden files and directories in
                     the process
+                max_mb : float, optional
+                    Per-file cap in megabytes; files are read in blocks
+                    of this size. Defaults to 16, 0 disables the cap
+                large_files : {'chunk', 'truncate', 'skip'}, optional
+                    What to do with files larger than max_mb. Defaults
+                    to chunk, which indexes them as several
+                    sub-documents
+                binary : {'skip', 'metadata', 'index'}, optional
+                    What to do with binary files such as images,
+                    archives and object files. Defaults to skip,
+                    metadata indexes only their path
+                store_content : bool, default=false, optional
+                    Whether to store a compressed copy of each file in
+                    the index, so search results can be highlighted
+                    without reading the files
+                analyzer : list of str, optional
+                    index only. EXT=KIND pairs choosing the analyzer of
+                    a file extension in a new index, KIND being plain,
+                    code or prose. See Analyzers for the defaults
+                ngrams : bool, default=false, optional
+                    index only. Whether a new index also keeps the
+                    n-grams of every word, for search --substring
+                merge : {'default', 'none', 'tiered'}, optional
+                    How segments are merged when changes are committed.
+                    default is whoosh's merging of small segments, none
+                    never merges and tiered merges segments of similar
+                    size ten at a time
+                commit_every : int, optional
+                    index and update only. Number of documents after
+                    which a checkpoint is committed
+                commit_mb : float, optional
+                    index and update only. Megabytes of content after
+                    which a checkpoint is committed
+                commit_seconds : float, optional
+                    index and update only. Seconds after which a
+                    checkpoint is committed
+                optimize : bool, default=false, optional
+                    index and update only. Whether to merge the whole
+                    index into one segment when done
+                ignore : bool, default=true, optional
+                    Whether to prune the files and directories matched
+                    by .gitignore and .dirindexerignore files
+                walkers : int, optional
+                    index and update only. Number of threads walking the
+                    top-level subdirectories concurrently. Defaults to 1
+                quiet : bool, default=false, optional
+                    Whether to leave out the line printed for every
+                    directory and file
+                stats : bool, default=false, optional
+                    Whether to print the time spent in each phase when
+                    done
 
             daemon(continued):
                 delay : float
                     Amount of time to wait in between each index commit.
+                debounce : float
+                    How long a path has to go without events before it is
+                    indexed.
+                batch_size : int
+                    Number of changed paths that triggers a commit
+                    without waiting for delay.
+                queue_size : int
+                    Number of file system events that may wait for the
+                    daemon's loop before repeated events of a path are
+                    coalesced.
+                reconcile : bool, default=true
+                    Whether to look for the changes made while the
+                    daemon was not running, in the background, on start.
+                stats_interval : float
+                    Seconds between two stats lines or metrics file
+                    updates.
+                metrics : str, optional
+                    File the counters and phase timers are written to
+                    as JSON every stats_interval.
 
             search:
                 keyword : str
@@ -64,6 +209,86 @@ class DirIndexer:
                     List of filetypes to exclude from the search
                 include : list of str, optional
                     List of filetypes to only include in search
+                server : str, optional
+                    Path of the socket of a serve process to send the
+                    search to
+                stats : bool, default=false, optional
+                    Whether to print the time spent parsing, searching
+                    and highlighting to stderr
+                cache : bool, default=false, optional
+                    Whether to answer from, and add to, the query cache
+                    saved in the index directory
+                offset : int, optional
+                    Number of leading results to skip. --page sets it
+                    to a multiple of limit, which defaults to 10 then
+                output : {'text', 'paths', 'jsonl'}, optional
+                    How results are printed: with highlighted snippets,
+                    as paths only or as JSON lines. Defaults to text
+                stream : bool, default=false, optional
+                    Whether to print results as they are matched, in
+                    index order and unranked
+                substring : bool, default=false, optional
+                    Whether to match the keyword inside words, using the
+                    n-grams of an index created with --ngrams
+
+            serve:
+                socket : str
+                    Path of the Unix socket to answer searches on
+                persist_cache : bool, default=false, optional
+                    Whether to load the query cache from the index
+                    directory on start and save it there on exit
+                stats : bool, default=false, optional
+                    Whether to print the counters, including cache hits
+                    and misses, on exit
+
+            search, serve:
+                cache_mb : float
+                    Memory the query cache may use, in megabytes. 0
+                    disables the cache of serve
+
+            bench:
+                files : int
+                    Number of files in the synthetic tree
+                size_kb : float
+                    Mean size of the text files in kilobytes
+                depth : int
+                    Maximum depth of the directories of the tree
+                binary_fraction : float
+                    Fraction of the files that are binary
+                churn : float
+                    Fraction of the files changed before the second update
+                queries : int
+                    Number of queries to time
+                seed : int
+                    Seed of the generator; the same seed gives the same
+                    tree and queries
+                bench_dir : str, optional
+                    Empty directory to run in instead of a temporary one,
+                    which is kept afterwards
+                output : str, optional
+                    File to write the JSON report to instead of stdout
+                shards : int, optional
+                    Number of shards to split the index into
+                index_args : list of str
+                    Extra options passed to index and update
+                startup_budget_ms : float
+                    Milliseconds the startup of a short command may take
+                create_args : list of str
+                    Options passed to index only: --analyzer and --ngrams
+
+            stats:
+                top : int
+                    Number of terms, duplicate groups and extensions
+                    listed in each section
+                sample : int
+                    Number of indexed files to stat to estimate how many
+                    documents are stale. 0 stats none
+                manifest : bool, default=false, optional
+                    Whether to also compare the index with its manifest,
+                    which is loaded whole, so memory grows with the
+                    number of files
+                json : bool, default=false, optional
+                    Whether to print the report as JSON
         """
         if(args.func == DirIndexer.index
            or args.func == DirIndexer.update
@@ -74,40 +299,365 @@ class DirIndexer:
             self.include = args.include
             self.processors = args.processors
             self.all = args.all
+            self.max_mb = args.max_mb
+            self.large_files = args.large_files
+            self.binary = args.binary
+            self.store_content = args.store_content
+            self.merge = args.merge
+            self.optimize = False
+            self.quiet = args.quiet
+            self.show_stats = args.stats
+            self.ignore = not args.no_ignore
+            self.ignore_cache = {}
+            self.walkers = 1
+            self.readers = args.readers
+
+        if(args.func == DirIndexer.index
+           or args.func == DirIndexer.update
+           ):
+            self.commit_every = args.commit_every
+            self.commit_mb = args.commit_mb
+            self.commit_seconds = args.commit_seconds
+            self.optimize = args.optimize
+            self.walkers = args.walkers or 1
+
+        if args.func == DirIndexer.index:
+            self.shards = args.shards
+            self.analyzer_args = args.analyzer
+            self.ngrams = args.ngrams
 
         if args.func == DirIndexer.daemon:
             if args.delay is not None:
                 self.delay = args.delay
             else:
                 self.delay = 5.0
+            self.debounce = args.debounce
+            self.batch_size = args.batch_size
+            self.queue_size = args.queue_size
+            self.reconcile = not args.no_reconcile
+            self.profile = args.profile
+            self.stats_interval = args.stats_interval
+            self.metrics = args.metrics
         if args.func == DirIndexer.search:
             self.keyword = args.keyword
             self.color = args.color
             self.limit = args.limit
             self.exclude = args.exclude
             self.include = args.include
+            self.server = args.server
+            self.show_stats = args.stats
+            self.cache_mb = args.cache_mb if args.cache else 0
+            self.offset = max(args.offset, 0)
+            if args.page:
+                self.limit = self.limit or 10
+                self.offset = (max(args.page, 1) - 1) * self.limit
+            self.output = args.output
+            self.stream = args.stream
+            self.substring = args.substring
+
+        if args.func == DirIndexer.serve:
+            self.socket = args.socket
+            self.cache_mb = args.cache_mb
+            self.persist_cache = args.persist_cache
+            self.show_stats = args.stats
+
+        if args.func == DirIndexer.bench:
+            self.files = args.files
+            self.size_kb = args.size_kb
+            self.depth = args.depth
+            self.binary_fraction = args.binary_fraction
+            self.churn = args.churn
+            self.queries = args.queries
+            self.seed = args.seed
+            self.bench_dir = args.dir
+            self.output = args.output
+            self.index_args = []
+            if args.processors:
+                self.index_args += ['-p', str(args.processors)]
+            if args.readers:
+                self.index_args += ['-r', str(args.readers)]
+            self.shards = args.shards
+            if args.store_content:
+                self.index_args += ['--store-content']
+            self.startup_budget_ms = args.startup_budget_ms
+            self.create_args = []
+            if args.analyzer:
+                self.create_args += ['--analyzer'] + args.analyzer
+            if args.ngrams:
+                self.create_args += ['--ngrams']
+
+        if args.func == DirIndexer.index_stats:
+            self.top = args.top
+            self.sample = args.sample
+            self.compare_manifest = args.manifest
+            self.json = args.json
 
         if args.func == DirIndexer.clear:
             pass
 
-    def get_ix(self):
-        """Creates the Schema and returns the index_writer"""
+        #Commands using an existing index find it from any directory
+        #below the one holding it
+        self.index_dir = self.find_index_dir(
+            getattr(args, 'index_dir', None),
+            search_up=args.func not in (DirIndexer.index, DirIndexer.clear))
+        self.roots = Roots(self.index_dir)
+        self.analyzers = None
+        if args.func == DirIndexer.search and self.server == '':
+            self.server = os.path.join(self.index_dir, "search.sock")
+        if args.func == DirIndexer.serve and self.socket is None:
+            self.socket = os.path.join(self.index_dir, "search.sock")
+        self.manifest = None
+        self.resuming = False
+        self.unchanged = set()
+        self.files_read = 0
+        self.bytes_read = 0
+        self.stats = Stats()
+        self.content_types = content_types
+        #Profiles of the threads of a profiled command, see profiled
+        self.profiles = None
+
+    @staticmethod
+    def find_index_dir(index_dir=None, search_up=False):
+        """
+        Returns index_dir if it is given. Otherwise returns .indexdir in
+        the working directory, or with search_up the nearest one in it
+        or its parents, relative to the working directory
+        """
+        if index_dir:
+            return index_dir
+        if search_up:
+            current = os.getcwd()
+            while True:
+                candidate = os.path.join(current, ".indexdir")
+                if os.path.isdir(candidate):
+                    return os.path.relpath(candidate)
+                parent = os.path.dirname(current)
+                if parent == current:
+                    break
+                current = parent
+        return ".indexdir"
+
+    def get_ix(self, index_dir=None):
+        """
+        Creates the Schema and returns the index
+
+        Parameters
+        ----------
+        index_dir : str, optional
+            The directory of the index, or of one of its shards. Defaults
+            to self.index_dir
+        """
+        from whoosh.fields import Schema, TEXT, ID, STORED
+        from whoosh.index import create_in, open_dir, exists_in
+        if index_dir is None:
+            index_dir = self.index_dir
         schema = Schema(title=TEXT(stored=True),
                         path=ID(stored=True, unique=True),
-                        content=TEXT(analyzer=
-                                     SpaceSeparatedTokenizer() |
-                                     LowercaseFilter()),
-                        date=STORED)
+                        ext=ID,
+                        date=STORED,
+                        chunk=STORED,
+                        chunk_len=STORED,
+                        blob=STORED,
+                        fingerprint=STORED,
+                        **self.get_analyzers().content_fields())
         #create if not exists
-        if not os.path.exists(".indexdir"):
-            os.mkdir(".indexdir")
-            create_in(".indexdir", schema)
+        if not exists_in(index_dir):
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            create_in(index_dir, schema)
 
-        ix = open_dir(".indexdir")
+        ix = open_dir(index_dir)
+
+        #add fields introduced since the index was created
+        missing = [name for name in schema.names() if name not in ix.schema]
+        if missing:
+            if not ix.is_empty():
+                print "The index predates the %s field(s); documents " \
+                      "indexed before now lack them until the index is " \
+                      "cleared and rebuilt" % ", ".join(missing)
+            writer = ix.writer()
+            for name in missing:
+                writer.add_field(name, schema[name])
+            writer.commit()
+            ix.close()
+            ix = open_dir(index_dir)
         return ix
 
+    def get_shard_count(self):
+        """Returns the number of shards the index is split into"""
+        try:
+            with open(os.path.join(self.index_dir, "shards")) as f:
+                return int(f.read())
+        except IOError:
+            return 1
+
+    def get_shard_dirs(self):
+        """
+        Returns the directories of the shards of the index. An index with
+        a single shard lives directly in self.index_dir
+        """
+        count = self.get_shard_count()
+        if count == 1:
+            return [self.index_dir]
+        return [os.path.join(self.index_dir, "shard-%02d" % k)
+                for k in range(count)]
+
+    @staticmethod
+    def shard_of(path, count):
+        """Returns the shard a path belongs to, by hashing the path"""
+        return (zlib.crc32(path.encode('utf-8')) & 0xffffffff) % count
+
+    def init_shards(self):
+        """
+        Sets up the shard layout requested by self.shards for a new index
+
+        Returns
+        -------
+        ok : bool
+            False if the index already exists with another shard count
+        """
+        count = self.get_shard_count()
+        if not self.shards or self.shards == count:
+            return True
+        if os.path.exists(self.index_dir) and os.listdir(self.index_dir):
+            print "The index has %d shard(s); clear it to change the " \
+                  "number of shards" % count
+            return False
+
+        if not os.path.exists(self.index_dir):
+            os.makedirs(self.index_dir)
+        with open(os.path.join(self.index_dir, "shards"), 'w') as f:
+            f.write("%d\n" % self.shards)
+        return True
+
+    def get_analyzers(self):
+        """
+        Returns the Analyzers of the index: those saved in it, plain text
+        only for an index created before they were saved, or the
+        defaults for an index yet to be created
+        """
+        from whoosh.index import exists_in
+        if self.analyzers is None:
+            analyzers = Analyzers(self.index_dir)
+            if (not analyzers.load()
+                    and not exists_in(self.get_shard_dirs()[0])):
+                analyzers.use_defaults()
+            self.analyzers = analyzers
+        return self.analyzers
+
+    def init_analyzers(self):
+        """
+        Saves the analyzers of a new index, the defaults overridden by
+        self.analyzer_args and self.ngrams
+
+        Returns
+        -------
+        ok : bool
+            False if an override is malformed, or the index already
+            exists with other analyzers
+        """
+        from whoosh.index import exists_in
+        overrides = {}
+        for arg in self.analyzer_args or ():
+            ext, sep, kind = arg.partition('=')
+            if not sep or kind not in Analyzers.FIELDS:
+                print "Expected EXT=KIND with KIND one of %s, got %s" % (
+                    ", ".join(Analyzers.FIELDS), arg)
+                return False
+            overrides[ext.lstrip('.')] = kind
+
+        analyzers = self.get_analyzers()
+        if exists_in(self.get_shard_dirs()[0]):
+            if (any(analyzers.kind(ext) != kind
+                    for ext, kind in overrides.iteritems())
+                    or self.ngrams and not analyzers.ngrams):
+                print "The index was created with other analyzers; clear " \
+                      "it to change them"
+                return False
+            return True
+
+        analyzers.extensions.update(overrides)
+        analyzers.ngrams = self.ngrams
+        analyzers.save()
+        return True
+
+    def register_root(self, directory, override=True):
+        """
+        Records directory as a root of the index with the current
+        exclude, include and all settings, and saves the roots
+
+        Parameters
+        ----------
+        directory : str
+            The directory to register
+        override : bool, optional
+            Whether to replace the settings of a root that is already
+            registered
+
+        Returns
+        -------
+        root : str
+            The root: the absolute path of directory, or directory as
+            given for an index created before roots were recorded, since
+            its paths are relative to it
+        existed : bool
+            Whether the root was already registered
+        """
+        from whoosh.index import exists_in
+        directory = unicode(directory)
+        absolute = os.path.abspath(directory)
+        if directory in self.roots.entries:
+            root = directory
+        elif (absolute in self.roots.entries or self.roots.entries
+              or not any(exists_in(d) for d in self.get_shard_dirs())):
+            root = absolute
+        else:
+            root = directory
+
+        existed = root in self.roots.entries
+        if override or not existed:
+            self.roots.entries[root] = dict(exclude=self.exclude,
+                                            include=self.include,
+                                            all=self.all)
+            self.roots.save()
+        return root, existed
+
+    def use_root(self, root):
+        """Makes a registered root, or a directory inside one, the
+        directory processed, with the exclude, include and all settings
+        of the root"""
+        settings = self.roots.entries[self.roots.find(root)]
+        self.directory = root
+        self.exclude = settings['exclude']
+        self.include = settings['include']
+        self.all = settings['all']
+
+    def get_roots(self):
+        """
+        Returns the roots update and daemon process: self.directory,
+        registered if it is new and with the settings given on the
+        command line if any, or else every root of the index. A
+        directory inside a root is processed with the settings of the
+        root, without being registered
+        """
+        self.roots.load()
+        if self.directory is not None:
+            override = bool(self.exclude or self.include or self.all)
+            directory = os.path.normpath(unicode(self.directory))
+            for path in (directory, os.path.abspath(directory)):
+                root = self.roots.find(path)
+                if root is None or root == path:
+                    continue
+                if override:
+                    print "Updating %s with the settings of %s; index it " \
+                          "to give it settings of its own" % (path, root)
+                return [path]
+            return [self.register_root(self.directory, override)[0]]
+        return sorted(self.roots.entries)
+
     def get_cores(self):
         """Returns the appropriate number of processor cores to use"""
+        import multiprocessing
         cores = multiprocessing.cpu_count() / 2
 
         if self.processors:
@@ -115,8 +665,356 @@ class DirIndexer:
 
         return cores
 
-    def scan_directory(self, dir_nm, writer, checknew=False,
-                       to_index=set(), indexed_paths=set()):
+    def get_commitargs(self):
+        """Returns the keyword arguments of the final commit of a writer,
+        according to self.merge and self.optimize. The merge policy is
+        timed as the merge phase"""
+        from whoosh.writing import MERGE_SMALL, NO_MERGE, OPTIMIZE
+        if self.optimize:
+            policy = OPTIMIZE
+        elif self.merge == 'none':
+            policy = NO_MERGE
+        elif self.merge == 'tiered':
+            policy = merge_tiered
+        else:
+            policy = MERGE_SMALL
+        stats = self.stats
+
+        def mergetype(writer, segments):
+            with stats.timer('merge'):
+                return policy(writer, segments)
+        return dict(mergetype=mergetype)
+
+    def get_checkpoint_writer(self, ix, writerargs=None):
+        """Returns a CheckpointWriter on ix using the checkpoint and merge
+        settings"""
+        return CheckpointWriter(ix, writerargs, self.commit_every,
+                                self.commit_mb, self.commit_seconds,
+                                self.get_commitargs(), stats=self.stats,
+                                log=self.log)
+
+    def get_readers(self):
+        """Returns the number of reader threads to use"""
+        import multiprocessing
+        readers = multiprocessing.cpu_count()
+
+        if self.readers:
+            readers = self.readers
+
+        return readers
+
+    def walk_files(self, dir_nm):
+        """
+        Walks a directory with os.scandir and yields the path and stat
+        result of every file that passes the hidden, ignore file, include
+        and exclude rules.
+
+        Directories are pruned before they are read: hidden ones, version
+        control ones and those matched by .gitignore or .dirindexerignore
+        rules, and the roots nested in dir_nm, which are walked with
+        their own settings. Symbolic links are followed, but a directory
+        reached twice is only walked once, which breaks symlink cycles. With
+        self.walkers above 1, the top-level subdirectories are walked by
+        that many threads.
+
+        Parameters
+        ----------
+        dir_nm : str
+            The directory to walk
+        """
+        self.log(dir_nm)
+        exclude = frozenset(self.exclude or ())
+        include = frozenset(self.include) if self.include else None
+        prefix = os.path.join(dir_nm, u'')
+        nested = frozenset(root for root in self.roots.entries
+                           if root.startswith(prefix))
+        visited = set()
+        lock = threading.Lock()
+        try:
+            st = os.stat(dir_nm)
+        except EnvironmentError:
+            return
+        visited.add((st.st_dev, st.st_ino))
+        #Rules of the ignore files above dir_nm, when the daemon walks a
+        #new subdirectory
+        chain = self.ignore_chain(dir_nm) if self.ignore else []
+        if chain is None:
+            return
+
+        if self.walkers <= 1:
+            for item in self.walk_tree([(dir_nm, chain)], visited, lock,
+                                       exclude, include, nested):
+                yield item
+            return
+
+        #Walk the first level here, then hand its subdirectories out
+        subtrees = Queue.Queue()
+        top = []
+        for item in self.walk_tree([(dir_nm, chain)], visited, lock, exclude,
+                                   include, nested, top):
+            yield item
+        for subtree in top:
+            subtrees.put(subtree)
+
+        found = Queue.Queue(maxsize=1024)
+
+        def walker():
+            try:
+                while True:
+                    try:
+                        subtree = subtrees.get_nowait()
+                    except Queue.Empty:
+                        return
+                    for item in self.walk_tree([subtree], visited, lock,
+                                               exclude, include, nested):
+                        found.put(item)
+            finally:
+                found.put(None)
+
+        walkers = min(self.walkers, len(top))
+        threads = [threading.Thread(target=self.profiled(walker))
+                   for i in range(walkers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while walkers:
+            item = found.get()
+            if item is None:
+                walkers -= 1
+            else:
+                yield item
+        #So that their profiles are in before the command's is written
+        for thread in threads:
+            thread.join()
+
+    def walk_tree(self, stack, visited, lock, exclude, include, nested,
+                  subdirs=None):
+        """
+        Walks the directories on stack depth first for walk_files,
+        yielding (path, stat) for every file kept
+
+        Parameters
+        ----------
+        stack : list of (str, list of IgnoreRules)
+            The directories to walk, with the rules of the ignore files
+            above them. Consumed
+        visited : set
+            (device, inode) pairs of the directories already walked,
+            shared between walkers
+        lock : threading.Lock
+            Lock guarding visited
+        exclude : frozenset of str
+            Extensions to leave out
+        include : frozenset of str or None
+            Extensions to keep, or None to keep all of them
+        nested : frozenset of str
+            Directories of the roots nested in the one walked, left out
+        subdirs : list, optional
+            If given, directories found are appended to it as stack items
+            instead of being walked
+        """
+        while stack:
+            root, chain = stack.pop()
+            try:
+                with self.stats.timer('walk'):
+                    entries = list(scandir(root))
+            except EnvironmentError:
+                continue
+
+            if self.ignore:
+                rules = IgnoreRules.load(root, [entry.name
+                                                for entry in entries])
+                if rules is not None:
+                    chain = chain + [rules]
+
+            for entry in entries:
+                #Remove hidden files and directories
+                name = entry.name
+                if not self.all and name[0] == '.':
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir and (name in IgnoreRules.VCS_DIRS
+                                   or entry.path in nested):
+                        continue
+                    if chain and IgnoreRules.ignored(chain, entry.path,
+                                                     is_dir):
+                        self.count('ignored paths')
+                        continue
+                    if is_dir:
+                        st = entry.stat()
+                        key = (st.st_dev, st.st_ino)
+                        with lock:
+                            if key in visited:
+                                continue
+                            visited.add(key)
+                        if subdirs is not None:
+                            subdirs.append((entry.path, chain))
+                        else:
+                            stack.append((entry.path, chain))
+                        continue
+                except EnvironmentError:
+                    continue
+
+                #Remove excluded files
+                ext = os.path.splitext(name)[1][1:]
+                if ext in exclude:
+                    continue
+                if include is not None and ext not in include:
+                    continue
+                try:
+                    with self.stats.timer('stat'):
+                        st = entry.stat()
+                except EnvironmentError:
+                    continue
+
+                yield unicode(entry.path), st
+
+    def is_ignored(self, path, is_dir=False):
+        """Returns whether the ignore files between self.directory and
+        path exclude path or one of the directories above it"""
+        if not self.ignore:
+            return False
+        chain = self.ignore_chain(path)
+        return chain is None or bool(
+            chain and IgnoreRules.ignored(chain, path, is_dir))
+
+    def ignore_chain(self, path):
+        """
+        Returns the rules of the ignore files from self.directory down to
+        the directory holding path, outermost first, or None if one of
+        those directories is ignored itself. The rules read are cached in
+        self.ignore_cache
+        """
+        root = self.roots.find(path) or self.directory
+        rel = os.path.relpath(path, root)
+        if rel == os.curdir or rel.startswith(os.pardir):
+            return []
+
+        chain = []
+        current = root
+        for i, part in enumerate(rel.split(os.sep)):
+            if i and chain and IgnoreRules.ignored(chain, current, True):
+                return None
+            if current not in self.ignore_cache:
+                try:
+                    names = os.listdir(current)
+                except EnvironmentError:
+                    names = []
+                self.ignore_cache[current] = IgnoreRules.load(current, names)
+            if self.ignore_cache[current] is not None:
+                chain.append(self.ignore_cache[current])
+            current = os.path.join(current, part)
+        return chain
+
+    def diff_directory(self, dir_nm, old, seen, changed):
+        """
+        Walks a directory and yields the path of every file that is new
+        or changed compared to a manifest, along with the fingerprint it
+        was indexed with if it is changed
+
+        Parameters
+        ----------
+        dir_nm : str
+            The directory to walk
+        old : dict or None
+            Manifest entries of the indexed files. Every file is yielded
+            if None
+        seen : dict
+            Filled with the manifest entry of every file walked, keeping
+            the fingerprint from old
+        changed : set
+            Filled with the paths of files that are already indexed but
+            have changed. When resuming an interrupted index, new files
+            are treated as changed too, as part of them may have been
+            committed before the manifest recorded them
+        """
+        for path, st in self.walk_files(dir_nm):
+            entry = old.get(path) if old is not None else None
+            if entry is None:
+                seen[path] = Manifest.entry(st)
+                if self.resuming:
+                    changed.add(path)
+                yield path, None
+                continue
+
+            seen[path] = Manifest.entry(st, entry[3])
+            if Manifest.is_modified(entry, seen[path]):
+                changed.add(path)
+                yield path, entry[3]
+
+    def write_changes(self, writer, items, changed, fingerprints=None):
+        """
+        Reads files through a pool of reader threads while the calling
+        thread hands the decoded documents to the writer.
+        Does not commit changes
+
+        Parameters
+        ----------
+        writer : whoosh.writing.IndexWriter
+            The whoosh index writer object to use
+        items : iterable of (str, str)
+            The paths to read and the fingerprints they were last indexed
+            with, as yielded by diff_directory
+        changed : set
+            Paths of files that are already indexed. Their old document
+            is removed before the new one is written, or afterwards if no
+            new document is written and the content did change. Emptied
+        fingerprints : dict, optional
+            Filled as files are added instead of a new dict, so a
+            checkpoint can see the files written so far
+
+        Returns
+        -------
+        x : int
+            Number of files that have been added to the index
+        fingerprints : dict
+            The fingerprint of every file whose documents have all been
+            written, by path
+        dropped : set
+            Paths removed from the index without a replacement
+        """
+        x = 0
+        if fingerprints is None:
+            fingerprints = {}
+        max_bytes = self.get_max_bytes()
+        if max_bytes is not None:
+            max_bytes *= 4
+        pool = ReaderPool(self, self.get_readers(), max_bytes=max_bytes)
+        for fields in pool.run(items):
+            path = fields['path']
+            #The first chunk of a changed file replaces the old document
+            if path in changed:
+                changed.discard(path)
+                self.remove_doc(writer, path)
+            self.write_doc(writer, fields)
+            if not fields.get('chunk'):
+                x += 1
+            #Only the last chunk of a file completes it
+            if 'chunk' not in fields or 'fingerprint' in fields:
+                fingerprints[path] = fields.get('fingerprint')
+        self.files_read += pool.files_read
+        self.bytes_read += pool.bytes_read
+
+        #Changed files that could no longer be read or were skipped,
+        #rather than found to have the same content
+        dropped = changed - self.unchanged
+        for path in dropped:
+            self.remove_doc(writer, path)
+        changed.clear()
+        return x, fingerprints, dropped
+
+    def deleted_paths(self, manifest, dir_nm, seen):
+        """Returns the paths under dir_nm that are in the manifest but
+        were not seen by the last walk, leaving out those of the roots
+        nested in dir_nm"""
+        prefix = os.path.join(dir_nm, u'')
+        root = self.roots.find(dir_nm)
+        return [path for path in manifest.entries
+                if path.startswith(prefix) and path not in seen
+                and self.roots.find(path) == root]
+
+    def scan_directory(self, dir_nm, writer, manifest=None, checknew=False):
         """
         Scans a directory, adds files to be processed to the index
         writer, then returns the number of changes
@@ -127,326 +1025,3412 @@ class DirIndexer:
         dir_nm : str
             The directory to scan
         writer : whoosh.writing.IndexWriter
-            The whoosh index writer object to use
+            The whoosh index writer object to use. A CheckpointWriter
+            saves the manifest with the files committed at each of its
+            checkpoints
+        manifest : Manifest, optional
+            The manifest to bring up to date with the files scanned.
+            Does not save the manifest, except at checkpoints
         checknew : bool, optional
-           Whether to only add new files or files from new folders
-           to the index
-        to_index : set, str, optional
-            For use with checknew
-            A list of new directories to index
-        indexed_paths : set, str, optional
-            For use with checknew
-            A list of directories that have already been searched
+            Whether to only add new or changed files to the index,
+            according to manifest. Changed and deleted files are removed
+            from the index first
 
         Returns
         -------
         x : int
             Number of files that have been added to the index
         """
+        old = manifest.entries if checknew else None
+        seen = {}
+        changed = set()
+        fingerprints = {}
+
+        def checkpoint():
+            #Record the files committed so far, so that resuming after a
+            #crash skips them
+            for path, fingerprint in fingerprints.iteritems():
+                manifest.entries[path] = seen[path][:3] + (fingerprint,)
+            manifest.save()
+
+        if manifest is not None and isinstance(writer, CheckpointWriter):
+            writer.on_checkpoint = checkpoint
+        items = self.diff_directory(dir_nm, old, seen, changed)
+        x, fingerprints, dropped = self.write_changes(writer, items, changed,
+                                                      fingerprints)
+
+        for path, fingerprint in fingerprints.iteritems():
+            seen[path] = seen[path][:3] + (fingerprint,)
+        for path in dropped:
+            seen.pop(path, None)
+
+        if checknew:
+            #Files that were in the manifest but are gone from disk
+            for path in self.deleted_paths(manifest, dir_nm, seen):
+                self.remove_doc(writer, path)
+                del manifest.entries[path]
+        if manifest is not None:
+            manifest.entries.update(seen)
+        return x
+
+    def scan_shards(self, roots, shard_dirs, manifest, checknew=False):
+        """
+        Scans the roots of the index into a sharded index. The walk
+        happens here while a ShardWorker process per shard reads, indexes
+        and commits the files that hash to it.
+
+        Each worker saves the files committed at its checkpoints to a
+        manifest in its shard, which a resumed run adds to the manifest
+        of the index; they are removed once the whole run is saved.
+
+        Parameters are as for scan_directory, with roots the registered
+        roots to scan and shard_dirs the directories of the shards.
+        Returns the number of files added.
+        """
+        import multiprocessing
+        checkpoints = [Manifest(d) for d in shard_dirs]
+        if self.resuming:
+            #Files committed at the checkpoints of the interrupted run
+            for checkpoint in checkpoints:
+                if checkpoint.load():
+                    manifest.entries.update(checkpoint.entries)
+        old = manifest.entries if checknew else None
+        seen = {}
+        changed = set()
+        count = len(shard_dirs)
+        readers = max(1, self.get_readers() // count)
+        queues = [multiprocessing.Queue(maxsize=1024) for d in shard_dirs]
+        results = multiprocessing.Queue()
+        workers = [ShardWorker(self, d, q, results, readers)
+                   for d, q in zip(shard_dirs, queues)]
+        for worker in workers:
+            worker.start()
+
+        def send(shard, op):
+            #Give up rather than block forever on a dead worker
+            while True:
+                try:
+                    return queues[shard].put(op, timeout=1)
+                except Queue.Full:
+                    if not workers[shard].is_alive():
+                        raise RuntimeError("%s stopped unexpectedly"
+                                           % shard_dirs[shard])
+
+        try:
+            for dir_nm in roots:
+                self.use_root(dir_nm)
+                for path, fingerprint in self.diff_directory(dir_nm, old,
+                                                             seen, changed):
+                    send(self.shard_of(path, count),
+                         ('add', path, fingerprint, path in changed,
+                          seen[path]))
+                if checknew:
+                    #Files that were in the manifest but are gone from disk
+                    for path in self.deleted_paths(manifest, dir_nm, seen):
+                        send(self.shard_of(path, count), ('remove', path))
+                        del manifest.entries[path]
+        finally:
+            for shard in range(count):
+                if workers[shard].is_alive():
+                    send(shard, None)
+
         x = 0
-        print dir_nm
-        for root, sub_folders, files in os.walk(dir_nm, followlinks=True):
-            #Remove hidden files
-            if not self.all:
-                files = [f for f in files if not f[0] == '.']
-                #os.walk will not process deleted directories
-                sub_folders[:] = [d for d in sub_folders if not d[0] == '.']
-
-            #Remove excluded files
-            if self.exclude:
-                files = [f for f in files
-                         if not os.path.splitext(f)[1][1:]
-                         in self.exclude]
-            if self.include:
-                files = [f for f in files
-                         if os.path.splitext(f)[1][1:]
-                         in self.include]
-
-            for cur_file in files:
-                path = unicode(os.path.join(root, cur_file))
-
-                #If a file is in the queue or is new, add it
-                if checknew and path in to_index or path not in indexed_paths:
-                    self.add_doc(writer, path)
-                    x += 1
-                elif not checknew:
-                    self.add_doc(writer, path)
-                    x += 1
+        for worker in workers:
+            result = results.get()
+            if 'error' in result:
+                raise RuntimeError("Writing shard %s" % result['error'])
+            x += result['added']
+            self.files_read += result['files_read']
+            self.bytes_read += result['bytes_read']
+            self.stats.merge(result['stats'])
+            for path, fingerprint in result['fingerprints'].iteritems():
+                seen[path] = seen[path][:3] + (fingerprint,)
+            for path in result['dropped']:
+                seen.pop(path, None)
+        for worker in workers:
+            worker.join()
+
+        manifest.entries.update(seen)
+        manifest.save()
+        for checkpoint in checkpoints:
+            if os.path.exists(checkpoint.path):
+                os.remove(checkpoint.path)
         return x
 
-    def index(self):
+    def write_index(self, roots, manifest, checknew=False):
         """
-        Index function
-        Adds self.directory to the index.
+        Scans roots of the index into every shard of the index with a
+        single writer per shard, and commits
+
+        Parameters are as for scan_directory, with roots the registered
+        roots to scan. Returns the number of files added.
         """
+        shard_dirs = self.get_shard_dirs()
+        if len(shard_dirs) > 1:
+            return self.scan_shards(roots, shard_dirs, manifest, checknew)
+
         ix = self.get_ix()
 
         #get the number of cores to use
         procs = self.get_cores()
 
-        writer = ix.writer(procs=procs)
-        dir_nm = unicode(self.directory)
-
-        #recursively scan the directory and add files
-        x = self.scan_directory(dir_nm, writer)
-
-        print "Writing %d files to index" % x
-        writer.commit()
-        ix.close()
+        writer = self.get_checkpoint_writer(ix, dict(procs=procs))
+        x = 0
+        try:
+            for dir_nm in roots:
+                self.use_root(dir_nm)
+                x += self.scan_directory(dir_nm, writer, manifest, checknew)
+        finally:
+            print "Writing %d files to index" % x
+            writer.commit()
+            ix.close()
+        return x
 
-    def update(self):
+    def mark_resume(self, directory):
         """
-        Update function
-        Checks self.directory for changes and adds them to the index
+        Leaves a marker in the index while directory is being indexed or
+        updated. If the marker of an interrupted run over the same
+        directory is found instead, sets self.resuming so the run picks
+        up from its last checkpoint
+
+        Returns
+        -------
+        marker : str
+            The path of the marker, to remove once the run is saved
         """
+        if not os.path.exists(self.index_dir):
+            os.makedirs(self.index_dir)
+        marker = os.path.join(self.index_dir, "resume")
+        if os.path.exists(marker):
+            with codecs.open(marker, 'r', 'utf-8') as f:
+                self.resuming = f.read() == directory
+        if self.resuming:
+            self.log("Resuming the interrupted run over %s" % directory)
+        with codecs.open(marker, 'w', 'utf-8') as f:
+            f.write(directory)
+        return marker
 
-        try:
-            ix = self.get_ix()
+    def print_throughput(self, start):
+        """Prints the files/sec and MB/sec achieved since start, and the
+        phase timers if self.show_stats is set"""
+        elapsed = max(time.time() - start, 1e-6)
+        mb = self.bytes_read / (1024.0 * 1024.0)
+        print "Indexed %d files (%.2f MB) in %.2f seconds: " \
+              "%.1f files/sec, %.2f MB/sec" % (
+                  self.files_read, mb, elapsed,
+                  self.files_read / elapsed, mb / elapsed)
+        for key, n in sorted(self.stats.counts.items()):
+            print "%s: %d" % (key.capitalize(), n)
+        if self.show_stats:
+            self.stats.report(sys.stdout)
 
-            #get the number of cores to use
-            procs = self.get_cores()
+    def log(self, message):
+        """Prints a progress message unless self.quiet is set"""
+        if not getattr(self, 'quiet', False):
+            print message
 
-            writer = ix.writer(procs=procs)
-            indexed_paths = set()   # Holds all paths already indexed
-            to_index = set()    # Holds a list of paths to index later
+    def report_stats(self):
+        """Prints a stats line if self.show_stats is set and rewrites the
+        metrics file if there is one"""
+        if self.show_stats:
+            print self.stats.line()
+        if self.metrics:
+            data = self.stats.as_dict()
+            data.update(time=time.time(), files_read=self.files_read,
+                        bytes_read=self.bytes_read)
+            tmp = self.metrics + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(data, f, sort_keys=True)
+            os.rename(tmp, self.metrics)
 
-            x = 0
-            with ix.searcher() as searcher:
-                for fields in searcher.all_stored_fields():
-                    indexed_path = fields['path']
-                    indexed_paths.add(indexed_path)
-
-                    #if the file has been deleted, remove it from the index
-                    if not os.path.exists(indexed_path):
-                        self.remove_doc(writer, indexed_path)
-                    else:
-                        indexed_time = fields['date']
-                        mtime = os.path.getmtime(indexed_path)
+    def index(self):
+        """
+        Index function
+        Adds self.directory to the index as one of its roots.
+        """
+        start = time.time()
+        if not self.init_shards() or not self.init_analyzers():
+            return
+        self.roots.load()
+        root, existed = self.register_root(self.directory)
+        marker = self.mark_resume(root)
+        if existed and not self.resuming:
+            self.log("%s is already indexed, updating it" % root)
+
+        #recursively scan the directory and add files
+        manifest = Manifest(self.index_dir)
+        manifest.load()
+        self.write_index([root], manifest,
+                         checknew=self.resuming or existed)
+        manifest.save()
+        os.remove(marker)
+        self.print_throughput(start)
 
-                        #If file has been changed,
-                        #delete it and add it to the queue
-                        if mtime > indexed_time:
-                            self.remove_doc(writer, indexed_path)
-                            to_index.add(indexed_path)
+    def update(self):
+        """
+        Update function
+        Checks self.directory, or every root of the index, for changes
+        and adds them to the index
+        """
 
-                x = self.scan_directory(self.directory, writer,
-                                        True, to_index, indexed_paths)
+        start = time.time()
+        roots = self.get_roots()
+        if not roots:
+            print "The index has no directories yet; index one first"
+            return
+        manifest = Manifest(self.index_dir)
+        if not manifest.load():
+            #index created before manifests; trust the stored dates
+            for index_dir in self.get_shard_dirs():
+                ix = self.get_ix(index_dir)
+                with ix.searcher() as searcher:
+                    manifest.entries.update(Manifest.from_stored_fields(
+                        searcher.all_stored_fields()))
+                ix.close()
 
-        finally:
-            print "Writing " + str(x) + " files to index."
-            writer.commit()
-            ix.close()
+        marker = self.mark_resume(u"\n".join(roots))
+        self.write_index(roots, manifest, checknew=True)
+        manifest.save()
+        os.remove(marker)
+        self.print_throughput(start)
 
     def daemon(self):
         """
         Daemon function
-        Continuosly watches self.directory for
-        changes and adds them to the index.
+        Continuosly watches self.directory, or every root of the index,
+        for changes and adds them to the index.
         """
-        ix = self.get_ix()
-        writer = BufferedWriter(ix, limit=100)
+        from whoosh.writing import BufferedWriter
+        from watchdog.observers import Observer
+        roots = self.get_roots()
+        if not roots:
+            print "The index has no directories yet; index one first"
+            return
+        indexes = [self.get_ix(d) for d in self.get_shard_dirs()]
+        self.manifest = Manifest(self.index_dir)
+        self.manifest.load()
+        #The event handler decides when to commit, so the writers neither
+        #commit on a timer nor before a whole batch is buffered
+        writers = [BufferedWriter(ix, period=None, limit=self.batch_size,
+                                  commitargs=self.get_commitargs())
+                   for ix in indexes]
+        if len(writers) == 1:
+            writer = writers[0]
+        else:
+            writer = ShardedWriter(writers)
         event_handler = IndexWriterEventHandler(writer, self, self.all,
                                                 self.exclude, self.include,
-                                                )
+                                                self.delay, self.debounce,
+                                                self.batch_size,
+                                                self.queue_size)
+        #Catch up on changes made while stopped, behind live events
+        if self.reconcile:
+            event_handler.reconcile(roots)
         observer = Observer()
-        observer.schedule(event_handler, path=self.directory, recursive=True)
+        for root in roots:
+            observer.schedule(event_handler, path=root, recursive=True)
         observer.start()
-        #observer.should_keep_running()
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+        #Flush pending changes when killed as well as on Ctrl+C
+        signal.signal(signal.SIGTERM, terminate)
 
         try:
             while True:
-                time.sleep(1)
+                time.sleep(self.stats_interval)
+                self.report_stats()
         except KeyboardInterrupt:
-            observer.stop()
-            writer.commit()
-            ix.close()
+            pass
+        #Let the observer hand over its last events before they are
+        #flushed
+        observer.stop()
         observer.join()
+        event_handler.stop()
+        with self.stats.timer('commit'):
+            writer.close()
+        for ix in indexes:
+            ix.close()
+        self.manifest.save()
+        self.report_stats()
 
-    def add_doc(self, writer, path):
-        """Writes a given file to the index_writer"""
+    def get_max_bytes(self):
+        """Returns the per-file byte cap, or None when files are unbounded"""
+        if not self.max_mb or self.max_mb <= 0:
+            return None
+        return int(self.max_mb * 1024 * 1024)
 
-        cur_file = codecs.open(path, encoding='utf-8', errors='ignore')
-        content = cur_file.read()
-        file_name = unicode(cur_file.name)
-        path = unicode(path)
-        modtime = os.path.getmtime(path)
-        print "Indexing %s" % file_name
-        writer.add_document(title=file_name, path=path,
-                            content=content, date=modtime)
+    def count(self, key, n=1):
+        """Increments a summary counter; safe to call from reader threads"""
+        self.stats.count(key, n)
 
-    def remove_doc(self, writer, path):
-        """Removes a given file from index_writer"""
+    def profiled(self, target):
+        """
+        Returns target, run under a profiler of its own that is added to
+        self.profiles if the command is profiled. cProfile only sees the
+        thread it runs on, so every thread working for the command is
+        started with this
+        """
+        profiles = self.profiles
+        if profiles is None:
+            return target
+        import cProfile
 
-        print "Removing %s" % path
-        writer.delete_by_term('path', path)
+        def run(*args):
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(target, *args)
+            finally:
+                profiles.append(profiler)
+        return run
 
-    def search(self):
-        """
-        Search function
-        Searches all indexes for self.keyword and prints them.
+    def dump_profile(self, profiler, path):
+        """Writes the profile of profiler merged with those of the threads
+        in self.profiles to path"""
+        import pstats
+        stats = pstats.Stats(profiler)
+        for profile in self.profiles or ():
+            stats.add(profile)
+        stats.dump_stats(path)
+        print "Profile written to %s" % path
+
+    def format_fingerprint(self, hasher, size):
+        """Returns the fingerprint string for a content hasher"""
+        return u"%s:%d:%s" % (HASH_NAME, size, hasher.hexdigest())
+
+    def fingerprint(self, cur_file, block_size=1024 * 1024):
+        """Returns the fingerprint of an open file, reading it in blocks"""
+        hasher = new_hash()
+        size = 0
+        while True:
+            with self.stats.timer('read'):
+                raw = cur_file.read(block_size)
+            if not raw:
+                return self.format_fingerprint(hasher, size)
+            with self.stats.timer('hash'):
+                hasher.update(raw)
+            size += len(raw)
+
+    def read_docs(self, path, fingerprint=None):
         """
+        Reads and decodes a given file, yielding one document per chunk
 
-        try:
-            ix = self.get_ix()
-            search_term = unicode(self.keyword)
+        Files are read in buffered blocks of at most the per-file byte cap,
+        so a file is never held in memory as a single string. Files larger
+        than the cap are handled according to self.large_files:
 
-            from whoosh.qparser import QueryParser
-            with ix.searcher() as searcher:
-                query = QueryParser("content", ix.schema).parse(
-                    u"%s" % search_term)
-                results = searcher.search(query, terms=True, limit=self.limit)
-                results.fragmenter = highlight.ContextFragmenter(maxchars=200,
-                                                                 surround=20)
-
-                #If stdin == stdout, the programs output is not being
-                #piped and colored output is fine
-                color = (self.color == 'always'
-                         or (self.color == 'auto'
-                             and os.fstat(0) == os.fstat(1)))
-                results.formatter = ColorFormatter(color=color)
-
-                #Remove excluded filetypes from search results
-                if self.exclude:
-                    results = [f for f in results
-                               if not os.path.splitext(f["path"])[1][1:]
-                               in self.exclude]
-                if self.include:
-                    results = [f for f in results
-                               if os.path.splitext(f["path"])[1][1:]
-                               in self.include]
-
-                print results
-                for i, result in enumerate(results, start=1):
-                    if color:
-                        print "Result %i: %s" % (
-                            i, colorama.Fore.GREEN + result["path"]
-                            + colorama.Fore.RESET)
-                    else:
-                        print "Result %i: %s" % (i, result["path"])
-                    with codecs.open(result["path"],
-                                     encoding='utf-8',
-                                     errors='ignore') as f:
-                        file_content = f.read()
-                        print result.highlights("content",
-                                                text=file_content,
-                                                top=10)
-                        print "\n"
-        finally:
-            ix.close()
+            chunk : every block becomes its own sub-document carrying the
+                    byte offset it starts at in the 'chunk' field
+            truncate : only the first block is indexed, and its length
+                       stored in the 'chunk_len' field
+            skip : the file is not indexed at all
 
-    def clear(self):
-        """Deletes all indexes"""
+        The last document of a file carries the content fingerprint of the
+        whole file, except for truncated files.
 
-        print "Deleting the current index..."
-        for root, dirs, files in os.walk(os.getcwd() + "/.indexdir/",
-                                         topdown=False):
-            for name in files:
-                print name
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        os.rmdir(os.getcwd() + "/.indexdir/")
+        Safe to call from reader threads; does not touch the index.
 
+        Parameters
+        ----------
+        path : str
+            The file to read
+        fingerprint : str, optional
+            The fingerprint the file had when it was last indexed. If its
+            content still matches, nothing is yielded and the path is
+            added to self.unchanged
 
-class ColorFormatter(highlight.Formatter):
-    """Class that handles colorized search output"""
+        Yields
+        ------
+        fields : dict
+            The fields to pass to the index writer
+        size : int
+            Number of bytes read from disk for this document
+        """
+        path = unicode(path)
+        max_bytes = self.get_max_bytes()
+        with open(path, 'rb') as cur_file:
+            st = os.fstat(cur_file.fileno())
+            modtime = st.st_mtime
+            fields = dict(title=path, path=path, date=modtime)
+            ext = os.path.splitext(path)[1][1:]
+            if ext:
+                fields['ext'] = ext
 
-    def __init__(self, between="\n", color=True):
-        self.between = between
-        self.color = color
+            #Only the metadata changed, keep the indexed document
+            if fingerprint is not None:
+                if self.fingerprint(cur_file) == fingerprint:
+                    self.count('unchanged files skipped')
+                    self.unchanged.add(path)
+                    return
+                cur_file.seek(0)
 
-    def format_token(self, text, token, replace=False):
-        tokentext = highlight.get_text(text, token, False)
-        if self.color:
-            return colorama.Back.YELLOW + tokentext + colorama.Back.RESET
-        else:
-            return tokentext
+            #Sniff the content type before reading the whole file
+            with self.stats.timer('read'):
+                head = cur_file.read(ContentTypeRegistry.SNIFF_BYTES)
+            ctype = self.content_types.sniff(path, head)
+            self.count('%s files' % ctype)
+            policy = self.content_types.policy(ctype, self.binary)
+            if policy == 'skip':
+                return
+            if policy == 'metadata':
+                yield fields, len(head)
+                return
+            cur_file.seek(0)
 
+            if max_bytes is None or st.st_size <= max_bytes:
+                with self.stats.timer('read'):
+                    raw = cur_file.read()
+                hasher = new_hash()
+                with self.stats.timer('hash'):
+                    hasher.update(raw)
+                with self.stats.timer('decode'):
+                    text = raw.decode('utf-8', 'ignore')
+                self.add_content(fields, text, raw)
+                fields.update(fingerprint=self.format_fingerprint(hasher,
+                                                                  len(raw)))
+                yield fields, len(raw)
+                return
 
-class IndexWriterEventHandler(FileSystemEventHandler):
-    """
-    Event handler customized for updating a directory with file changes.
-    Implements a LIFO queue to eliminate redundant commits.
-    """
-    def __init__(self, writer, di, all=False,
-                 exclude=[], include=None, delay=5.0):
-        self.writer = writer
-        self.di = di
-        self.all = all
-        self.exclude = exclude
-        self.include = include
-        self.delay = delay
-        self.queue = Queue.LifoQueue()
-        self.clear_queue()
+            if self.large_files == 'skip':
+                self.log("Skipping %s (%d bytes)" % (path, st.st_size))
+                self.count('large files skipped')
+                return
+            if self.large_files == 'truncate':
+                with self.stats.timer('read'):
+                    raw = cur_file.read(max_bytes)
+                with self.stats.timer('decode'):
+                    text = raw.decode('utf-8', 'ignore')
+                self.add_content(fields, text, raw)
+                #So that highlighting reads back only the part indexed
+                fields['chunk_len'] = len(raw)
+                self.count('large files truncated')
+                yield fields, len(raw)
+                return
 
-    def dispatch(self, event):
-        print("Adding event to queue...")
-        self.on_any_event(event)
-        self.queue.put(event)
-
-    def clear_queue(self):
-        """Commits queue to index and clears it."""
-        print("Emtpying queue...")
-        urls = []
-        while not self.queue.empty():
-            event = self.queue.get()
-            if watchdog.utils.has_attribute(event, 'dest_path'):
-                if event.dest_path not in urls:
-                    urls.append(event.dest_path)
-                    FileSystemEventHandler.dispatch(self, event)
-            else:
-                if event.src_path not in urls:
-                    urls.append(event.src_path)
-                    FileSystemEventHandler.dispatch(self, event)
+            self.count('large files chunked')
+            decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+            hasher = new_hash()
+            size = 0
+            offset = 0
+            tail = ''
+            pending = None
 
-        if urls != []:
-            print("Commiting %i changes." % len(urls))
-            self.writer.commit()
-            print("Done.")
+            def chunk_doc(data, final=False):
+                with self.stats.timer('decode'):
+                    text = decoder.decode(data, final)
+                chunk = dict(fields, chunk=offset, chunk_len=len(data))
+                self.add_content(chunk, text, data)
+                return chunk, len(data)
 
-        threading.Timer(self.delay, self.clear_queue).start()
+            while True:
+                with self.stats.timer('read'):
+                    raw = cur_file.read(max_bytes)
+                with self.stats.timer('hash'):
+                    hasher.update(raw)
+                size += len(raw)
+                if not raw:
+                    break
+                #Carry the last partial word over to the next chunk. The
+                #bytes are cut rather than the decoded text, so offsets
+                #stay those on disk where invalid UTF-8 is dropped; space
+                #and newline bytes never occur inside a UTF-8 sequence
+                data = tail + raw
+                cut = max(data.rfind(' '), data.rfind('\n'))
+                if cut > 0:
+                    data, tail = data[:cut], data[cut:]
+                else:
+                    tail = ''
+                #Hold each chunk back until the next one is read, so the
+                #last one can carry the fingerprint
+                if pending is not None:
+                    yield chunk_doc(pending)
+                    offset += len(pending)
+                pending = data
+            #The last partial word ends the last chunk
+            pending = (pending or '') + tail
+            if pending:
+                chunk, n = chunk_doc(pending, final=True)
+                chunk['fingerprint'] = self.format_fingerprint(hasher, size)
+                yield chunk, n
 
-    def path_is_good(self, path):
+    def add_content(self, fields, text, raw):
         """
-        Analyzes path according to rules in self.all, self.include,
-        and self.exclude and returns whether the path passes.
+        Adds the decoded text of a document to the content field of the
+        analyzer of its extension, along with its n-grams if the index
+        keeps them and a compressed copy of its bytes if
+        self.store_content is set
         """
-        if not self.all:
-            if os.path.basename(path)[0] == '.':
-                return False
-        if self.exclude:
-            if os.path.splitext(path)[1][1:] in self.exclude:
-                return False
-        if self.include:
-            if os.path.splitext(path)[1][1:] not in self.include:
-                return False
-        return True
+        analyzers = self.get_analyzers()
+        fields[analyzers.field(fields.get('ext'))] = text
+        if analyzers.ngrams:
+            fields['ngram'] = text
+        if self.store_content:
+            fields['blob'] = zlib.compress(raw)
 
-    def on_created(self, event):
-        #print("on_create")
-        if self.path_is_good(event.src_path):
-            self.di.add_doc(self.writer, event.src_path)
+    def read_text(self, result):
+        """
+        Returns the text a search hit was indexed from, decompressing the
+        copy stored with --store-content if there is one and otherwise
+        reading the file, or only the chunk of it the hit covers
+        """
+        blob = result.get('blob')
+        if blob is not None:
+            return zlib.decompress(blob).decode('utf-8', 'ignore')
 
-    def on_moved(self, event):
-        #print("on_moved")
-        self.di.remove_doc(self.writer, event.src_path)
-        if self.path_is_good(event.dest_path):
-            self.di.add_doc(self.writer, event.dest_path)
+        with open(result['path'], 'rb') as f:
+            if result.get('chunk_len') is not None:
+                #Truncated files have a length but no offset
+                f.seek(result.get('chunk') or 0)
+                raw = f.read(result['chunk_len'])
+            else:
+                raw = f.read()
+        return raw.decode('utf-8', 'ignore')
 
-    def on_deleted(self, event):
-        #print("on_deleted")
-        self.di.remove_doc(self.writer, event.src_path)
+    def write_doc(self, writer, fields):
+        """Writes the fields of a file read by read_docs to the index_writer"""
 
-    def on_modified(self, event):
-        #print("on_modified")
-        if self.path_is_good(event.src_path):
-            self.di.remove_doc(self.writer, event.src_path)
-            self.di.add_doc(self.writer, event.src_path)
+        self.log("Indexing %s" % fields['title'])
+        #Tokenizing happens inside add_document, in the writer's
+        #subprocesses when there are several
+        with self.stats.timer('add'):
+            writer.add_document(**fields)
+        self.count('documents added')
 
+    def remove_doc(self, writer, path):
+        """Removes a given file from index_writer"""
+
+        self.log("Removing %s" % path)
+        writer.delete_by_term('path', path)
+        self.count('documents removed')
+        if self.manifest is not None:
+            self.manifest.entries.pop(path, None)
+
+    def search(self):
+        """
+        Search function
+        Searches all indexes for self.keyword and prints them.
+        If self.server is set, the query is answered by a running serve
+        process instead, falling back to searching in-process if none is
+        listening. With a cache, the output of a query already answered
+        since the last commit is printed without searching.
+        """
+
+        #If stdin == stdout, the programs output is not being
+        #piped and colored output is fine
+        color = (self.color == 'always'
+                 or (self.color == 'auto'
+                     and os.fstat(0) == os.fstat(1)))
+
+        try:
+            self.write_search(color)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            #The reader went away, as with | head; point stdout at
+            #devnull so flushing it on exit does not fail again
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+            return
+        if self.show_stats:
+            self.stats.report(sys.stderr, counts=True)
+
+    def write_search(self, color):
+        """Writes the results of the search to stdout, from the server,
+        the cache or the index"""
+        if self.server and self.search_server(color):
+            return
+
+        cache = self.open_cache(persist=True)
+        #A cached answer does not need the index opened
+        if cache is not None and self.answer_from_cache(
+                cache, sys.stdout, self.keyword, self.limit, self.include,
+                self.exclude, color, self.offset, self.output, self.stream,
+                self.substring):
+            return
+
+        searcher = self.open_searcher()
+        try:
+            self.run_search(searcher, sys.stdout, self.keyword,
+                            self.limit, self.include, self.exclude,
+                            color, cache, self.offset, self.output,
+                            self.stream, self.substring)
+        finally:
+            searcher.close()
+            if cache is not None:
+                cache.save()
+
+    def open_cache(self, persist=False):
+        """
+        Returns a QueryCache of self.cache_mb megabytes, loaded from the
+        index directory if persist is set, or None if the size is 0
+        """
+        if not self.cache_mb:
+            return None
+        path = None
+        if persist:
+            path = os.path.join(self.index_dir, QueryCache.FILENAME)
+        cache = QueryCache(int(self.cache_mb * 1024 * 1024), path)
+        cache.load()
+        return cache
+
+    def answer_from_cache(self, cache, out, keyword, limit=None,
+                          include=None, exclude=None, color=False,
+                          offset=0, output='text', stream=False,
+                          substring=False):
+        """
+        Writes the cached output of a search if the cache has it for the
+        current generation of the index. Parameters are as for
+        run_search
+
+        Returns
+        -------
+        answered : bool
+            Whether the output was in the cache
+        """
+        cache.validate(self.get_generation())
+        text = cache.get(self.cache_key(keyword, limit, include, exclude,
+                                        color, offset, output, stream,
+                                        substring))
+        if text is None:
+            return False
+        self.count('cache hits')
+        out.write(text)
+        return True
+
+    @staticmethod
+    def cache_key(keyword, limit, include, exclude, color, offset=0,
+                  output='text', stream=False, substring=False):
+        """Returns the QueryCache key of the output of a search"""
+        return ('results', unicode(keyword), limit, tuple(include or ()),
+                tuple(exclude or ()), color, offset, output, stream,
+                substring)
+
+    def get_generation(self):
+        """
+        Returns the generation of every shard of the index, which
+        changes whenever a writer commits to it. Read from the names of
+        the table of contents files as whoosh does, so that answering
+        from the query cache needs no whoosh import
+        """
+        generations = []
+        for index_dir in self.get_shard_dirs():
+            try:
+                names = os.listdir(index_dir)
+            except OSError:
+                names = []
+            found = [int(match.group(1)) for match in
+                     (TOC_PATTERN.match(name) for name in names) if match]
+            generations.append(max(found) if found else -1)
+        return tuple(generations)
+
+    def open_searcher(self):
+        """
+        Returns a searcher over the whole index: a whoosh searcher, or a
+        ShardedSearcher if the index is sharded
+        """
+        shard_dirs = self.get_shard_dirs()
+        if len(shard_dirs) == 1:
+            return self.get_ix().searcher()
+        return ShardedSearcher(shard_dirs, self.get_ix(shard_dirs[0]).schema)
+
+    def run_search(self, searcher, out, keyword, limit=None,
+                   include=None, exclude=None, color=False, cache=None,
+                   offset=0, output='text', stream=False, substring=False):
+        """
+        Runs a query against an open searcher and writes the results
+
+        Parameters
+        ----------
+        searcher : whoosh.searching.Searcher or ShardedSearcher
+            The searcher to query
+        out : file
+            Where to write the results
+        keyword : str
+            The keyword to search for
+        limit : int, optional
+            The number of results to display, None for all of them
+        include : list of str, optional
+            List of filetypes to only include in search
+        exclude : list of str, optional
+            List of filetypes to exclude from the search
+        color : bool, optional
+            Whether to colorize the results
+        cache : QueryCache, optional
+            Cache of parsed queries and of the output of earlier
+            searches, dropped when the index has changed since
+        offset : int, optional
+            The number of leading results to skip, for paging
+        output : {'text', 'paths', 'jsonl'}, optional
+            text writes each result with highlighted snippets of its
+            file; paths writes only the path of each result and jsonl a
+            JSON object per result, neither reading any file
+        stream : bool, optional
+            Whether to write results as they are matched, in index order
+            and unscored, instead of ranking every match first
+        substring : bool, optional
+            Whether to match the keyword inside words, in the n-gram
+            field, instead of matching whole words in the content fields
+        """
+        from whoosh.query import Or, Term
+        from whoosh import highlight
+        search_term = unicode(keyword)
+        if substring and 'ngram' not in searcher.schema:
+            print >>out, "The index keeps no n-grams; create it with " \
+                         "index --ngrams to search for substrings"
+            return
+        if cache is not None:
+            if self.answer_from_cache(cache, out, keyword, limit, include,
+                                      exclude, color, offset, output,
+                                      stream, substring):
+                return
+            self.count('cache misses')
+            #Render into a buffer so the output can be cached
+            final, out = out, StringIO.StringIO()
+
+        from whoosh.qparser import MultifieldParser
+        query = None
+        if cache is not None:
+            query = cache.get(('query', search_term, substring))
+        if query is None:
+            #Each analyzer indexes into its own field; search them all
+            if substring:
+                fieldnames = ['ngram']
+            else:
+                fieldnames = [name for name in Analyzers.FIELDS.values()
+                              if name in searcher.schema]
+            with self.stats.timer('parse'):
+                query = MultifieldParser(fieldnames, searcher.schema).parse(
+                    u"%s" % search_term)
+            if cache is not None:
+                cache.put(('query', search_term, substring), query)
+        #Let the searcher drop filtered filetypes before scoring, so a
+        #limited search still returns up to limit hits
+        allow = None
+        if include:
+            allow = Or([Term("ext", unicode(ext)) for ext in include])
+        restrict = None
+        if exclude:
+            restrict = Or([Term("ext", unicode(ext)) for ext in exclude])
+
+        end = offset + limit if limit else None
+        with self.stats.timer('search'):
+            if stream:
+                if isinstance(searcher, ShardedSearcher):
+                    results = searcher.stream(query, allow, restrict)
+                else:
+                    results = StreamedResults([searcher], searcher.schema,
+                                              query, allow, restrict)
+                hits = itertools.islice(results, offset, end)
+            else:
+                #Rank the first end hits and skip offset of them, as
+                #search_page does, without its clamping of a page past
+                #the end to the last one
+                results = searcher.search(query, terms=True, limit=end,
+                                          filter=allow, mask=restrict)
+                hits = results[offset:] if offset else results
+        results.fragmenter = highlight.ContextFragmenter(maxchars=200,
+                                                         surround=20)
+        results.formatter = color_formatter(color)
+
+        for i, result in enumerate(hits, start=offset + 1):
+            self.write_hit(out, i, result, output, color, substring)
+            self.count('results written')
+            if stream:
+                out.flush()
+
+        if cache is not None:
+            text = out.getvalue()
+            cache.put(self.cache_key(keyword, limit, include, exclude,
+                                     color, offset, output, stream,
+                                     substring), text)
+            final.write(text)
+
+    def write_hit(self, out, rank, result, output='text', color=False,
+                  substring=False):
+        """
+        Writes one result of run_search
+
+        Parameters
+        ----------
+        out : file
+            Where to write the result
+        rank : int
+            The position of the result, from 1
+        result : whoosh.searching.Hit or ShardHit
+            The result
+        output : {'text', 'paths', 'jsonl'}, optional
+            The output format, see run_search
+        color : bool, optional
+            Whether to colorize the result
+        substring : bool, optional
+            Whether the result matched in the n-gram field
+        """
+        if output == 'paths':
+            print >>out, result["path"]
+            return
+        if output == 'jsonl':
+            print >>out, json.dumps(dict(rank=rank, path=result["path"],
+                                         score=result.score,
+                                         chunk=result.get("chunk")))
+            return
+
+        if color:
+            import colorama
+            print >>out, "Result %i: %s" % (
+                rank, colorama.Fore.GREEN + result["path"]
+                + colorama.Fore.RESET)
+        else:
+            print >>out, "Result %i: %s" % (rank, result["path"])
+        try:
+            with self.stats.timer('read'):
+                file_content = self.read_text(result)
+        except EnvironmentError as e:
+            print >>out, "Could not read %s: %s" % (result["path"], e)
+        else:
+            if substring:
+                fieldname = 'ngram'
+            else:
+                fieldname = self.get_analyzers().field(
+                    os.path.splitext(result["path"])[1][1:])
+            with self.stats.timer('highlight'):
+                highlights = result.highlights(fieldname,
+                                               text=file_content,
+                                               top=10)
+            print >>out, highlights
+        print >>out, "\n"
+
+    def search_server(self, color):
+        """
+        Sends the search to the serve process listening on self.server
+        and copies its answer to stdout
+
+        Returns
+        -------
+        answered : bool
+            False if no server could be reached
+        """
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.server)
+        except socket.error:
+            client.close()
+            return False
+
+        try:
+            request = dict(keyword=self.keyword, limit=self.limit,
+                           include=self.include, exclude=self.exclude,
+                           color=color, offset=self.offset,
+                           output=self.output, stream=self.stream,
+                           substring=self.substring)
+            client.sendall(json.dumps(request) + "\n")
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                sys.stdout.write(data)
+        finally:
+            client.close()
+        return True
+
+    def serve(self):
+        """
+        Serve function
+        Keeps the index open and answers searches sent to self.socket by
+        search --server. The searcher is refreshed whenever a writer such
+        as the daemon has committed since the last query.
+        """
+        searcher = self.open_searcher()
+        if os.path.exists(self.socket):
+            os.remove(self.socket)
+        cache = self.open_cache(self.persist_cache)
+        server = SearchServer(self.socket, self, searcher, cache)
+        print "Serving searches on %s" % self.socket
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.searcher.close()
+            os.remove(self.socket)
+            if cache is not None:
+                cache.save()
+            if self.show_stats:
+                print self.stats.line()
+
+    def bench(self):
+        """
+        Bench function
+        Generates a synthetic tree, times indexing, updating and searching
+        it, and prints the measurements as JSON
+        """
+        output = os.path.abspath(self.output) if self.output else None
+        root = self.bench_dir
+        if root is None:
+            root = tempfile.mkdtemp(prefix="dirindexer-bench-")
+        elif os.path.exists(root) and os.listdir(root):
+            print "%s is not empty" % root
+            return
+
+        bench = Benchmark(os.path.abspath(root), self.files, self.size_kb,
+                          self.depth, self.binary_fraction, self.churn,
+                          self.seed, self.index_args, self.shards,
+                          self.create_args)
+        try:
+            report = bench.run(self.queries, self.startup_budget_ms)
+        finally:
+            if self.bench_dir is None:
+                shutil.rmtree(root)
+
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if output:
+            with open(output, 'w') as f:
+                f.write(text + "\n")
+        else:
+            print text
+
+    def index_stats(self):
+        """
+        Stats function
+        Reports what the index holds and where its size comes from, read
+        from its files, term statistics and stored fields only: the
+        indexed tree is not walked. Every pass streams over the index, so
+        memory stays bounded on indexes of millions of documents, unless
+        self.compare_manifest loads the manifest
+        """
+        from whoosh.index import open_dir, exists_in
+        shard_dirs = self.get_shard_dirs()
+        if not exists_in(shard_dirs[0]):
+            print "There is no index in %s" % self.index_dir
+            return
+
+        readers = [open_dir(index_dir).reader() for index_dir in shard_dirs]
+        try:
+            report = {'documents': sum(r.doc_count() for r in readers),
+                      'shards': len(readers)}
+            report['segments'] = self.segment_stats(shard_dirs, readers)
+            report['size_mb'] = sum(s['size_mb'] for s in report['segments'])
+            report['fields'] = self.term_stats(readers)
+            report.update(self.file_stats(readers))
+        finally:
+            for reader in readers:
+                reader.close()
+
+        if self.json:
+            print json.dumps(report, indent=2, sort_keys=True)
+        else:
+            self.print_stats(report)
+
+    def segment_stats(self, shard_dirs, readers):
+        """
+        Returns the documents, deleted documents and size on disk of every
+        segment of every shard
+        """
+        segments = []
+        for shard, (index_dir, reader) in enumerate(zip(shard_dirs, readers)):
+            names = os.listdir(index_dir)
+            for leaf, offset in reader.leaf_readers():
+                segment = leaf.segment()
+                if segment is None:
+                    #Empty index or shard
+                    continue
+                name = segment.segment_id()
+                size = sum(os.path.getsize(os.path.join(index_dir, n))
+                           for n in names if n.startswith(name))
+                segments.append({'shard': shard,
+                                 'segment': name,
+                                 'documents': segment.doc_count_all(),
+                                 'deleted': segment.deleted_count(),
+                                 'size_mb': size / (1024.0 * 1024.0)})
+        return segments
+
+    def term_stats(self, readers):
+        """
+        Returns the number of terms and postings of every indexed field,
+        and its self.top terms with the most postings. Only the top terms
+        of each shard are kept while streaming over its terms; their
+        postings are then summed over all shards
+        """
+        fields = {}
+        schema = readers[0].schema
+        for name in schema.names():
+            if not schema[name].indexed:
+                continue
+            terms = postings = 0
+            candidates = set()
+            for reader in readers:
+                top = []
+                for text, info in reader.iter_field(name):
+                    frequency = info.doc_frequency()
+                    terms += 1
+                    postings += frequency
+                    if len(top) < self.top:
+                        heapq.heappush(top, (frequency, text))
+                    elif frequency > top[0][0]:
+                        heapq.heapreplace(top, (frequency, text))
+                candidates.update(text for frequency, text in top)
+            totals = [(sum(r.doc_frequency(name, text) for r in readers), text)
+                      for text in candidates]
+            fields[name] = {'terms': terms,
+                            'postings': postings,
+                            'top_terms': [[text, frequency] for frequency, text
+                                          in heapq.nlargest(self.top, totals)]}
+        return fields
+
+    def file_stats(self, readers):
+        """
+        Streams over the stored fields of every document once and returns
+        the files, documents and bytes of every extension, the groups of
+        duplicate files by content fingerprint, and estimates of the
+        stale documents. The manifest is only loaded, whole, if
+        self.compare_manifest is set
+        """
+        manifest = Manifest(self.index_dir)
+        has_manifest = self.compare_manifest and manifest.load()
+        extensions = collections.defaultdict(
+            lambda: {'files': 0, 'documents': 0, 'mb': 0.0, 'stored_mb': 0.0})
+        files = manifest_only = not_in_manifest = unfingerprinted = 0
+        sample = []
+        rng = random.Random(0)
+        documents = sum(r.doc_count() for r in readers)
+        duplicates = DuplicateFinder(documents // DuplicateFinder.PARTITION
+                                     + 1)
+        try:
+            for reader in readers:
+                for fields in reader.all_stored_fields():
+                    path = fields['path']
+                    ext = extensions[os.path.splitext(path)[1][1:].lower()]
+                    ext['documents'] += 1
+                    ext['stored_mb'] += len(fields.get('blob') or '') \
+                        / (1024.0 * 1024.0)
+                    fingerprint = fields.get('fingerprint')
+                    if fingerprint:
+                        #Only the last document of a chunked file has it
+                        size = int(fingerprint.split(':')[1])
+                        ext['mb'] += size / (1024.0 * 1024.0)
+                        duplicates.add(fingerprint, path)
+                    if fields.get('chunk'):
+                        continue
+
+                    files += 1
+                    ext['files'] += 1
+                    if not fingerprint:
+                        unfingerprinted += 1
+                    if has_manifest and path not in manifest.entries:
+                        not_in_manifest += 1
+                    #Reservoir sample of the files
+                    if len(sample) < self.sample:
+                        sample.append((path, fields.get('date')))
+                    else:
+                        k = rng.randint(0, files - 1)
+                        if k < self.sample:
+                            sample[k] = (path, fields.get('date'))
+
+            groups = []
+            duplicate_files = redundant_files = redundant_mb = 0
+            for fingerprint, paths in duplicates.groups():
+                size = int(fingerprint.split(':')[1]) / (1024.0 * 1024.0)
+                duplicate_files += len(paths)
+                redundant_files += len(paths) - 1
+                redundant_mb += size * (len(paths) - 1)
+                group = (size * (len(paths) - 1), len(paths),
+                         sorted(paths)[:10])
+                if len(groups) < self.top:
+                    heapq.heappush(groups, group)
+                elif group > groups[0]:
+                    heapq.heapreplace(groups, group)
+        finally:
+            duplicates.close()
+
+        if has_manifest:
+            manifest_only = max(
+                len(manifest.entries) - (files - not_in_manifest), 0)
+        stale = {'deleted': sum(r.doc_count_all() - r.doc_count()
+                                for r in readers),
+                 'manifest': has_manifest,
+                 'not_in_manifest': not_in_manifest,
+                 'manifest_only': manifest_only}
+        if sample:
+            stale.update(self.sample_stale(sample, manifest, files))
+
+        top_extensions = heapq.nlargest(
+            self.top, extensions.iteritems(),
+            key=lambda item: item[1]['mb'] + item[1]['stored_mb'])
+        return {'files': files,
+                'unfingerprinted': unfingerprinted,
+                'extensions': [dict(ext=ext, **counts)
+                               for ext, counts in top_extensions],
+                'other_extensions': len(extensions) - len(top_extensions),
+                'duplicates': {'groups': duplicates.count,
+                               'files': duplicate_files,
+                               'redundant_files': redundant_files,
+                               'redundant_mb': redundant_mb,
+                               'largest': [{'redundant_mb': mb,
+                                            'copies': copies,
+                                            'paths': paths}
+                                           for mb, copies, paths
+                                           in sorted(groups, reverse=True)]},
+                'stale': stale}
+
+    def sample_stale(self, sample, manifest, files):
+        """
+        Stats the sampled (path, date) pairs of indexed files and returns
+        how many were changed or removed since they were indexed, and the
+        stale documents that makes for all files. Compares with the
+        manifest entries if loaded, and else with the stored dates
+        """
+        changed = missing = 0
+        for path, date in sample:
+            try:
+                new = Manifest.entry(os.stat(path))
+            except OSError:
+                missing += 1
+                continue
+            old = manifest.entries.get(path)
+            if old is None:
+                old = (int((date or 0) * 1e9), None, None, None)
+            if Manifest.is_modified(old, new):
+                changed += 1
+        return {'sampled': len(sample),
+                'sampled_changed': changed,
+                'sampled_missing': missing,
+                'estimated_stale': int(round(
+                    float(changed + missing) / len(sample) * files))}
+
+    def print_stats(self, report):
+        """Prints the report of index_stats as text"""
+        print "%d documents, %d files, %.2f MB in %d shard(s)" % (
+            report['documents'], report['files'], report['size_mb'],
+            report['shards'])
+
+        print "\nSegments:"
+        for segment in report['segments']:
+            print "  %s%-28s %9d docs %9d deleted %10.2f MB" % (
+                "shard %d " % segment['shard'] if report['shards'] > 1 else "",
+                segment['segment'], segment['documents'],
+                segment['deleted'], segment['size_mb'])
+
+        print "\nFields:"
+        for name, field in sorted(report['fields'].iteritems(),
+                                  key=lambda item: -item[1]['postings']):
+            print "  %-10s %10d terms %12d postings" % (
+                name, field['terms'], field['postings'])
+            if field['top_terms'] and name != 'path':
+                print "    " + ", ".join(
+                    "%s (%d)" % (text, frequency)
+                    for text, frequency in field['top_terms'])
+
+        print "\nExtensions:"
+        for ext in report['extensions']:
+            print "  %-10s %9d files %9d docs %10.2f MB %10.2f MB stored" % (
+                ext['ext'] or "(none)", ext['files'], ext['documents'],
+                ext['mb'], ext['stored_mb'])
+        if report['other_extensions']:
+            print "  and %d other extension(s)" % report['other_extensions']
+
+        duplicates = report['duplicates']
+        print "\nDuplicates: %d group(s) of %d files, %d redundant " \
+              "file(s), %.2f MB" % (
+                  duplicates['groups'], duplicates['files'],
+                  duplicates['redundant_files'], duplicates['redundant_mb'])
+        for group in duplicates['largest']:
+            print "  %d copies, %.2f MB redundant:" % (
+                group['copies'], group['redundant_mb'])
+            for path in group['paths']:
+                print "    %s" % path
+        if report['unfingerprinted']:
+            print "  %d file(s) indexed without a fingerprint are not " \
+                  "compared" % report['unfingerprinted']
+
+        stale = report['stale']
+        print "\nStale:"
+        print "  %d deleted document(s) awaiting a merge" % stale['deleted']
+        if stale['manifest']:
+            print "  %d indexed file(s) missing from the manifest, %d in " \
+                  "the manifest without a document, such as skipped " \
+                  "binary files" % (
+                      stale['not_in_manifest'],
+                      stale['manifest_only'])
+        if 'sampled' in stale:
+            print "  %d of %d sampled file(s) changed and %d removed, about " \
+                  "%d stale file(s) in all" % (
+                      stale['sampled_changed'], stale['sampled'],
+                      stale['sampled_missing'], stale['estimated_stale'])
+        else:
+            print "  Use --sample N to estimate the files changed since " \
+                  "they were indexed"
+
+    def clear(self):
+        """Deletes all indexes"""
+
+        print "Deleting the current index..."
+        for root, dirs, files in os.walk(self.index_dir, topdown=False):
+            for name in files:
+                print name
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(self.index_dir)
+
+
+class Manifest:
+    """
+    Compact table of path -> (mtime_ns, size, inode, fingerprint) for every
+    file walked into the index, stored next to the index files.
+
+    update diffs a single directory walk against it instead of loading
+    and stat-ing every stored document.
+    """
+
+    FILENAME = "manifest"
+
+    def __init__(self, index_dir):
+        """
+        Parameters
+        ----------
+        index_dir : str
+            The directory holding the index
+        """
+        self.path = os.path.join(index_dir, self.FILENAME)
+        self.entries = {}
+
+    @staticmethod
+    def entry(st, fingerprint=None):
+        """Returns the manifest entry for a stat result and optionally the
+        content fingerprint of the file"""
+        mtime_ns = getattr(st, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1e9)
+        return (mtime_ns, st.st_size, st.st_ino, fingerprint)
+
+    @staticmethod
+    def from_stored_fields(stored_fields):
+        """
+        Builds entries from the stored fields of an index created before
+        manifests existed. Only the modification time is known for those.
+        """
+        return dict((fields['path'], (int(fields['date'] * 1e9), None, None,
+                                      fields.get('fingerprint')))
+                    for fields in stored_fields)
+
+    @staticmethod
+    def is_modified(old, new):
+        """Returns whether the stat part of two manifest entries differs"""
+        if old[1] is None:
+            #Allow for the rounding of the float dates in old indexes
+            return new[0] > old[0] + 1000
+        return old[:3] != new[:3]
+
+    def load(self):
+        """Loads the manifest from disk, returns whether it existed"""
+        try:
+            with open(self.path, 'rb') as f:
+                self.entries = cPickle.load(f)
+        except IOError:
+            return False
+        return True
+
+    def save(self):
+        """Atomically writes the manifest to disk"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(self.entries, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+
+class Roots:
+    """
+    The directories an index covers, each with the exclude, include and
+    all settings it is walked with. Stored as JSON next to the index
+    files, so update and daemon can process every root in one pass.
+    """
+
+    FILENAME = "roots.json"
+
+    def __init__(self, index_dir):
+        """
+        Parameters
+        ----------
+        index_dir : str
+            The directory holding the index
+        """
+        self.path = os.path.join(index_dir, self.FILENAME)
+        self.entries = {}
+
+    def load(self):
+        """Loads the roots, returning False if none were saved"""
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)['roots']
+        except (IOError, ValueError, KeyError):
+            return False
+        return True
+
+    def save(self):
+        """Atomically writes the roots to disk"""
+        index_dir = os.path.dirname(self.path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(roots=self.entries), f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def find(self, path):
+        """Returns the root path is in, the deepest one if roots nest, or
+        None"""
+        found = None
+        for root in self.entries:
+            if path == root or path.startswith(os.path.join(root, u'')):
+                if found is None or len(root) > len(found):
+                    found = root
+        return found
+
+
+class Analyzers:
+    """
+    The analyzer the content of each file extension is indexed with,
+    and whether the n-grams of every word are kept for substring search.
+    Chosen when an index is created and stored as JSON next to the index
+    files, since every writer must put a file in the same field.
+
+    Each analyzer fills its own content field:
+
+        plain : content
+            Split on whitespace and lowercased, extensions not listed
+        code : code
+            Split on punctuation and on camelCase and snake_case
+            boundaries, keeping the joined identifier as well, so parts
+            of identifiers are found without wildcards
+        prose : prose
+            Split into words and lowercased, without stop words
+
+    Only whoosh's own analyzers are used, as the schema is pickled into
+    the index and has to load without this module.
+    """
+
+    FILENAME = "analyzers.json"
+    FIELDS = collections.OrderedDict([('plain', 'content'),
+                                      ('code', 'code'),
+                                      ('prose', 'prose')])
+    CODE = frozenset(['c', 'h', 'cc', 'cpp', 'hpp', 'cs', 'java', 'kt',
+                      'scala', 'go', 'rs', 'swift', 'm', 'py', 'rb', 'pl',
+                      'php', 'lua', 'js', 'ts', 'jsx', 'tsx', 'sh', 'sql'])
+    PROSE = frozenset(['txt', 'md', 'rst', 'tex', 'org', 'adoc', 'html',
+                       'htm'])
+
+    def __init__(self, index_dir):
+        """
+        Parameters
+        ----------
+        index_dir : str
+            The directory holding the index
+        """
+        self.path = os.path.join(index_dir, self.FILENAME)
+        self.extensions = {}
+        self.ngrams = False
+
+    def use_defaults(self):
+        """Analyzes the CODE extensions as code and PROSE ones as prose"""
+        self.extensions = dict([(ext, 'code') for ext in self.CODE]
+                               + [(ext, 'prose') for ext in self.PROSE])
+
+    def kind(self, ext):
+        """Returns the analyzer of a file extension"""
+        return self.extensions.get(ext, 'plain')
+
+    def field(self, ext):
+        """Returns the content field of a file extension"""
+        return self.FIELDS[self.kind(ext)]
+
+    @staticmethod
+    def analyzer(kind):
+        """Returns a new whoosh analyzer of a kind"""
+        from whoosh.analysis import (SpaceSeparatedTokenizer,
+                                     LowercaseFilter, RegexTokenizer,
+                                     IntraWordFilter, StandardAnalyzer)
+        if kind == 'code':
+            return (RegexTokenizer(r"\w+")
+                    | IntraWordFilter(mergewords=True, mergenums=True)
+                    | LowercaseFilter())
+        if kind == 'prose':
+            return StandardAnalyzer()
+        return SpaceSeparatedTokenizer() | LowercaseFilter()
+
+    def content_fields(self):
+        """Returns the schema fields the analyzers index into, by name"""
+        from whoosh.fields import TEXT
+        from whoosh.analysis import NgramWordAnalyzer
+        kinds = set(self.extensions.values()) | set(['plain'])
+        fields = dict((self.FIELDS[kind], TEXT(analyzer=self.analyzer(kind)))
+                      for kind in kinds)
+        if self.ngrams:
+            fields['ngram'] = TEXT(analyzer=NgramWordAnalyzer(3, 4))
+        return fields
+
+    def load(self):
+        """Loads the analyzers, returning False if none were saved"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.extensions = data.get('extensions', {})
+        self.ngrams = data.get('ngrams', False)
+        return True
+
+    def save(self):
+        """Atomically writes the analyzers to disk"""
+        index_dir = os.path.dirname(self.path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(extensions=self.extensions, ngrams=self.ngrams),
+                      f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+class IgnoreRules:
+    """
+    Glob rules of the .gitignore and .dirindexerignore files of one
+    directory, with gitignore semantics: '#' starts a comment, '!'
+    re-includes, a trailing '/' only matches directories, a pattern with
+    a '/' in it is relative to the directory and one without matches the
+    name at any depth, and '**' matches any number of directories.
+    Rules of deeper files and later lines take precedence.
+    """
+
+    FILENAMES = ('.gitignore', '.dirindexerignore')
+    VCS_DIRS = frozenset(['.git', '.hg', '.svn'])
+
+    def __init__(self, base, lines):
+        """
+        Parameters
+        ----------
+        base : str
+            The directory the rules are relative to
+        lines : iterable of str
+            The lines of the ignore files
+        """
+        self.base = base
+        self.rules = []     # (regex, negate, dir_only, anchored)
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if line.endswith(' ') and not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line:
+                self.rules.append((self.translate(line), negate, dir_only,
+                                   anchored))
+
+    @classmethod
+    def load(cls, directory, names):
+        """
+        Returns the rules of the ignore files among names in directory,
+        or None if it has none
+        """
+        lines = []
+        for filename in cls.FILENAMES:
+            if filename in names:
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        lines.extend(f.readlines())
+                except EnvironmentError:
+                    pass
+        if not lines:
+            return None
+        rules = cls(directory, lines)
+        return rules if rules.rules else None
+
+    @staticmethod
+    def translate(pattern):
+        """Compiles a gitignore glob into a regular expression"""
+        i, n = 0, len(pattern)
+        out = []
+        while i < n:
+            c = pattern[i]
+            if pattern.startswith('**/', i):
+                out.append('(?:.*/)?')
+                i += 3
+                continue
+            if pattern.startswith('/**', i) and i + 3 == n:
+                out.append('/.*')
+                i += 3
+                continue
+            if c == '*':
+                out.append('.*' if pattern.startswith('**', i) else '[^/]*')
+                i += 2 if pattern.startswith('**', i) else 1
+                continue
+            if c == '?':
+                out.append('[^/]')
+            elif c == '[' and pattern.find(']', i + 2) != -1:
+                j = pattern.find(']', i + 2)
+                body = pattern[i + 1:j]
+                if body[0] == '!':
+                    body = '^' + body[1:]
+                out.append('[%s]' % body.replace('\\', '\\\\'))
+                i = j + 1
+                continue
+            elif c == '\\' and i + 1 < n:
+                i += 1
+                out.append(re.escape(pattern[i]))
+            else:
+                out.append(re.escape(c))
+            i += 1
+        return re.compile('(?:%s)\\Z' % ''.join(out))
+
+    def match(self, path, is_dir):
+        """
+        Returns True if path is ignored by these rules, False if it is
+        re-included and None if no rule matches it
+        """
+        rel = path[len(self.base):].lstrip(os.sep).replace(os.sep, '/')
+        name = rel.rpartition('/')[2]
+        for regex, negate, dir_only, anchored in reversed(self.rules):
+            if dir_only and not is_dir:
+                continue
+            if regex.match(rel if anchored else name):
+                return not negate
+        return None
+
+    @staticmethod
+    def ignored(chain, path, is_dir):
+        """Returns whether the rules of chain, outermost first, ignore
+        path"""
+        for rules in reversed(chain):
+            result = rules.match(path, is_dir)
+            if result is not None:
+                return result
+        return False
+
+
+class Stats:
+    """
+    Counters and per-phase timers of an index, update, daemon or search.
+    Safe to use from reader threads.
+
+    Phase times are summed over every thread and shard process taking
+    part, so with several readers the read phase can add up to more
+    than the time elapsed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.times = collections.Counter()
+        self.calls = collections.Counter()
+
+    def count(self, key, n=1):
+        """Increments a counter"""
+        with self.lock:
+            self.counts[key] += n
+
+    def add_time(self, phase, seconds):
+        """Adds one call of seconds to a phase"""
+        with self.lock:
+            self.times[phase] += seconds
+            self.calls[phase] += 1
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Context manager timing its body as one call of a phase"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.time() - start)
+
+    def as_dict(self):
+        """Returns the counters and timers as plain dicts"""
+        with self.lock:
+            return dict(counts=dict(self.counts), times=dict(self.times),
+                        calls=dict(self.calls))
+
+    def merge(self, data):
+        """Adds the counters and timers of another as_dict()"""
+        with self.lock:
+            self.counts.update(data['counts'])
+            self.times.update(data['times'])
+            self.calls.update(data['calls'])
+
+    def report(self, out, counts=False):
+        """Writes a table of the phases, slowest first, preceded by the
+        counters if counts is set"""
+        data = self.as_dict()
+        if counts:
+            for key, n in sorted(data['counts'].items()):
+                print >>out, "%s: %d" % (key.capitalize(), n)
+        print >>out, "%-10s %10s %10s" % ("Phase", "Seconds", "Calls")
+        for phase, seconds in sorted(data['times'].items(),
+                                     key=lambda item: -item[1]):
+            print >>out, "%-10s %10.3f %10d" % (phase, seconds,
+                                                data['calls'][phase])
+
+    def line(self):
+        """Returns the counters and timers on a single line"""
+        data = self.as_dict()
+        counts = ", ".join("%s=%d" % item
+                           for item in sorted(data['counts'].items()))
+        times = ", ".join("%s=%.3fs" % item
+                          for item in sorted(data['times'].items()))
+        if not counts and not times:
+            return "Stats: nothing done yet"
+        return "Stats: %s | %s" % (counts, times)
+
+
+class QueryCache:
+    """
+    LRU cache of parsed queries and search output, bounded by the memory
+    its values take.
+
+    Entries are only valid for the generation of the index they were
+    made with; the whole cache is dropped as soon as a commit changes it.
+    Not thread-safe: SearchServer only searches under its lock.
+    """
+
+    FILENAME = "query-cache"
+
+    def __init__(self, max_bytes, path=None):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Approximate memory the values may take
+        path : str, optional
+            File the cache is loaded from and saved to
+        """
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = collections.OrderedDict()    # key -> (size, value)
+        self.size = 0
+        self.generation = None
+        self.dirty = False
+
+    @staticmethod
+    def sizeof(key, value):
+        """Estimates the memory of an entry"""
+        if not isinstance(value, basestring):
+            value = repr(value)
+        return len(repr(key)) + len(value) + 100
+
+    def validate(self, generation):
+        """Drops every entry if the index is now at another generation"""
+        if generation != self.generation:
+            if self.entries:
+                self.dirty = True
+            self.entries.clear()
+            self.size = 0
+            self.generation = generation
+
+    def get(self, key):
+        """Returns the value of key, or None"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.entries[key] = entry
+        return entry[1]
+
+    def put(self, key, value):
+        """Adds an entry, evicting the least recently used ones to make
+        room"""
+        size = self.sizeof(key, value)
+        if size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[0]
+        while self.entries and self.size + size > self.max_bytes:
+            self.size -= self.entries.popitem(last=False)[1][0]
+        self.entries[key] = (size, value)
+        self.size += size
+        self.dirty = True
+
+    def load(self):
+        """Loads the cache saved at self.path, if any"""
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = cPickle.load(f)
+        except Exception:
+            return
+        self.generation = data['generation']
+        for key, value in data['entries']:
+            self.put(key, value)
+        self.dirty = False
+
+    def save(self):
+        """Atomically writes the cache to self.path if it changed"""
+        if self.path is None or not self.dirty:
+            return
+        #Parsed queries stay in memory: unpickling them would import
+        #whoosh, which answering from the saved output does not need
+        data = dict(generation=self.generation,
+                    entries=[(key, value)
+                             for key, (size, value)
+                             in self.entries.iteritems()
+                             if key[0] != 'query'])
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+
+class ContentTypeRegistry:
+    """
+    Pluggable registry deciding how each file's content is indexed.
+
+    Files are matched first by extension, then by the leading bytes of the
+    file, and anything left over is classified as 'text' or 'binary' by
+    looking for NUL bytes and control characters in the first few KB.
+    Every type has a policy:
+
+        index : the decoded content is indexed
+        metadata : only the title, path and date are indexed
+        skip : the file is left out of the index
+        None : follow the --binary option of the current run
+    """
+
+    SNIFF_BYTES = 8192
+    TEXT_CHARS = bytearray([7, 8, 9, 10, 12, 13, 27]) + \
+        bytearray(range(0x20, 0x7f)) + bytearray(range(0x80, 0x100))
+
+    def __init__(self):
+        self.policies = collections.OrderedDict(text='index', binary=None)
+        self.extensions = {}
+        self.magic = []
+
+    def register(self, name, extensions=(), magic=(), policy=None):
+        """
+        Registers a content type
+
+        Parameters
+        ----------
+        name : str
+            The name of the type, as reported in the summary counters
+        extensions : list of str, optional
+            Extensions, without the dot, of the files of this type
+        magic : list of str, optional
+            Leading bytes identifying files of this type
+        policy : {'index', 'metadata', 'skip', None}, optional
+            How files of this type are indexed
+        """
+        self.policies[name] = policy
+        for ext in extensions:
+            self.extensions[ext.lower()] = name
+        for prefix in magic:
+            self.magic.append((prefix, name))
+
+    def policy(self, name, binary='skip'):
+        """Returns the policy for a content type, given the --binary
+        policy for types without their own"""
+        policy = self.policies.get(name)
+        if policy is None:
+            return binary
+        return policy
+
+    def is_binary(self, head):
+        """Returns whether the given leading bytes look like binary data"""
+        if not head:
+            return False
+        if b'\x00' in head:
+            return True
+        control = head.translate(None, self.TEXT_CHARS)
+        return len(control) > len(head) * 0.3
+
+    def sniff(self, path, head):
+        """Returns the name of the content type of a file"""
+        ext = os.path.splitext(path)[1][1:].lower()
+        if ext in self.extensions:
+            return self.extensions[ext]
+        for prefix, name in self.magic:
+            if head.startswith(prefix):
+                return name
+        if self.is_binary(head):
+            return 'binary'
+        return 'text'
+
+
+content_types = ContentTypeRegistry()
+content_types.register(
+    'image', ['png', 'jpg', 'jpeg', 'gif', 'bmp', 'ico', 'tif', 'tiff',
+              'webp', 'psd'],
+    [b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'II*\x00', b'MM\x00*'])
+content_types.register(
+    'archive', ['zip', 'gz', 'tgz', 'bz2', 'xz', '7z', 'rar', 'tar', 'jar',
+                'whl', 'egg'],
+    [b'PK\x03\x04', b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00', b'7z\xbc\xaf'])
+content_types.register(
+    'object', ['o', 'a', 'so', 'dylib', 'dll', 'exe', 'pyc', 'pyo', 'class',
+               'obj', 'lib'],
+    [b'\x7fELF', b'\xca\xfe\xba\xbe', b'\xcf\xfa\xed\xfe'])
+content_types.register(
+    'database', ['sqlite', 'sqlite3', 'db'], [b'SQLite format 3\x00'])
+content_types.register('document', ['pdf'], [b'%PDF'])
+
+
+class ReaderPool:
+    """
+    Bounded pool of reader threads feeding decoded documents to the
+    index writer.
+
+    A feeder thread walks the directory into a bounded path queue, the
+    reader threads open and decode the files, and the documents are handed
+    back through a bounded document queue so only the calling thread ever
+    touches the index writer.
+    """
+
+    _DONE = object()
+
+    def __init__(self, di, readers=1, backlog=4, max_bytes=None):
+        """
+        Parameters
+        ----------
+        di : DirIndexer
+            The DirIndexer whose read_docs is used to read files
+        readers : int, optional
+            Number of reader threads
+        backlog : int, optional
+            Number of queued items allowed per reader before the
+            producers block
+        max_bytes : int, optional
+            Number of bytes of content allowed to wait for the writer
+            before the readers block. Unbounded if None
+        """
+        self.di = di
+        self.readers = max(1, readers)
+        self.paths = Queue.Queue(maxsize=self.readers * backlog)
+        self.docs = Queue.Queue(maxsize=self.readers * backlog)
+        self.max_bytes = max_bytes
+        self.pending_bytes = 0
+        self.pending = threading.Condition()
+        self.error = None
+        self.files_read = 0
+        self.bytes_read = 0
+
+    def feed(self, paths):
+        """Puts every (path, fingerprint) pair on the path queue, then one
+        stop marker for each reader"""
+        try:
+            for path in paths:
+                self.paths.put(path)
+        except Exception as e:
+            self.error = e
+        finally:
+            for i in range(self.readers):
+                self.paths.put(self._DONE)
+
+    def read(self):
+        """
+        Reader thread body. An error other than a failed read is kept in
+        self.error for run to raise; the remaining paths are then drained
+        unread so that the feeder never blocks
+        """
+        try:
+            while True:
+                item = self.paths.get()
+                if item is self._DONE:
+                    return
+                if self.error is not None:
+                    continue
+                path, fingerprint = item
+                try:
+                    for fields, size in self.di.read_docs(path, fingerprint):
+                        self.reserve(size)
+                        self.docs.put((fields, size))
+                except EnvironmentError as e:
+                    print "Could not read %s: %s" % (path, e)
+                    self.di.count('unreadable files')
+                except Exception as e:
+                    self.error = e
+        finally:
+            self.docs.put(self._DONE)
+
+    def reserve(self, size):
+        """Blocks until size more bytes may wait for the writer"""
+        if self.max_bytes is None:
+            return
+        with self.pending:
+            while (self.pending_bytes
+                   and self.pending_bytes + size > self.max_bytes):
+                self.pending.wait()
+            self.pending_bytes += size
+
+    def release(self, size):
+        """Marks size bytes as handed to the writer"""
+        if self.max_bytes is None:
+            return
+        with self.pending:
+            self.pending_bytes -= size
+            self.pending.notify_all()
+
+    def run(self, paths):
+        """
+        Reads every (path, fingerprint) pair from the given iterable, as
+        taken by DirIndexer.read_docs, and yields the fields of each
+        document in the order they finish reading
+        """
+        threads = [threading.Thread(target=self.di.profiled(self.feed),
+                                    args=(paths,))]
+        threads += [threading.Thread(target=self.di.profiled(self.read))
+                    for i in range(self.readers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        running = self.readers
+        while running:
+            item = self.docs.get()
+            if item is self._DONE:
+                running -= 1
+                continue
+            fields, size = item
+            if not fields.get('chunk'):
+                self.files_read += 1
+            self.bytes_read += size
+            yield fields
+            self.release(size)
+
+        #So that their profiles are in before the command's is written
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class ShardWorker:
+    """
+    Process indexing the files of one shard of a sharded index.
+
+    Receives ('add', path, fingerprint, changed, manifest entry) and
+    ('remove', path) operations on its queue until a None, commits, and
+    then puts a dict describing what it did on the results queue. At
+    each checkpoint, the manifest entries of the files committed so far
+    are saved to a manifest in the shard, so that an interrupted run can
+    resume from there.
+    """
+
+    def __init__(self, di, index_dir, queue, results, readers=1):
+        """
+        Parameters
+        ----------
+        di : DirIndexer
+            The DirIndexer whose settings are used to read the files
+        index_dir : str
+            The directory of the shard
+        queue : multiprocessing.Queue
+            The operations to apply to the shard
+        results : multiprocessing.Queue
+            Where to report the results
+        readers : int, optional
+            Number of reader threads to use
+        """
+        self.di = di
+        self.index_dir = index_dir
+        self.queue = queue
+        self.results = results
+        self.readers = readers
+        self.process = None
+
+    def start(self):
+        """Starts the process, which runs self.run"""
+        import multiprocessing
+        self.process = multiprocessing.Process(target=self.run)
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def join(self):
+        self.process.join()
+
+    def items(self, changed, removals, entries):
+        """Yields the files to add from the queue, collecting changed
+        files into changed, files to remove into removals and the
+        manifest entries of the files into entries"""
+        while True:
+            op = self.queue.get()
+            if op is None:
+                return
+            if op[0] == 'remove':
+                removals.append(op[1])
+                continue
+            kind, path, fingerprint, is_changed, entry = op
+            if is_changed:
+                changed.add(path)
+            entries[path] = entry
+            yield path, fingerprint
+
+    def run(self):
+        di = self.di
+        di.readers = self.readers
+        try:
+            ix = di.get_ix(self.index_dir)
+            writer = di.get_checkpoint_writer(ix)
+            changed = set()
+            removals = []
+            entries = {}
+            fingerprints = {}
+            manifest = Manifest(self.index_dir)
+
+            def checkpoint():
+                for path, fingerprint in fingerprints.iteritems():
+                    manifest.entries[path] = entries[path][:3] + (
+                        fingerprint,)
+                manifest.save()
+            writer.on_checkpoint = checkpoint
+            x = 0
+            try:
+                x, fingerprints, dropped = di.write_changes(
+                    writer, self.items(changed, removals, entries), changed,
+                    fingerprints)
+                for path in removals:
+                    di.remove_doc(writer, path)
+            finally:
+                print "Writing %d files to %s" % (x, self.index_dir)
+                sys.stdout.flush()
+                writer.commit()
+                ix.close()
+        except Exception as e:
+            self.results.put(dict(error="%s: %r" % (self.index_dir, e)))
+            raise
+
+        self.results.put(dict(added=x, fingerprints=fingerprints,
+                              dropped=dropped, stats=di.stats.as_dict(),
+                              files_read=di.files_read,
+                              bytes_read=di.bytes_read))
+
+
+class ShardedWriter:
+    """
+    Writer routing documents to the writers of the shards of an index by
+    their path, for code expecting a single writer
+    """
+
+    def __init__(self, writers):
+        """
+        Parameters
+        ----------
+        writers : list of whoosh.writing.IndexWriter
+            The writers of the shards, in shard order
+        """
+        self.writers = writers
+
+    def writer_for(self, path):
+        """Returns the writer of the shard a path belongs to"""
+        return self.writers[DirIndexer.shard_of(path, len(self.writers))]
+
+    def add_document(self, **fields):
+        self.writer_for(fields['path']).add_document(**fields)
+
+    def delete_by_term(self, fieldname, text):
+        if fieldname == 'path':
+            self.writer_for(text).delete_by_term(fieldname, text)
+        else:
+            for writer in self.writers:
+                writer.delete_by_term(fieldname, text)
+
+    def commit(self):
+        for writer in self.writers:
+            writer.commit()
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class CheckpointWriter:
+    """
+    Writer committing checkpoints during a long index or update, so a
+    crash only loses the changes since the last one.
+
+    A checkpoint commits the underlying writer without merging segments
+    and opens a new one once enough documents, content or time have gone
+    by since the previous checkpoint. The merge policy in commitargs only
+    applies to the final commit.
+    """
+
+    def __init__(self, ix, writerargs=None, docs=None, mb=None,
+                 seconds=None, commitargs=None, on_checkpoint=None,
+                 stats=None, log=None):
+        """
+        Parameters
+        ----------
+        ix : whoosh.index.Index
+            The index to write to
+        writerargs : dict, optional
+            Keyword arguments of ix.writer()
+        docs : int, optional
+            Number of documents after which to commit a checkpoint
+        mb : float, optional
+            Megabytes of content after which to commit a checkpoint
+        seconds : float, optional
+            Seconds after which to commit a checkpoint
+        commitargs : dict, optional
+            Keyword arguments of the final commit
+        on_checkpoint : callable, optional
+            Called after each checkpoint is committed
+        stats : Stats, optional
+            Where to time the commits
+        log : callable, optional
+            Prints a progress message, such as DirIndexer.log. Messages
+            are printed if None
+        """
+        self.ix = ix
+        self.writerargs = writerargs or {}
+        self.docs = docs
+        self.max_bytes = mb * 1024 * 1024 if mb else None
+        self.seconds = seconds
+        self.commitargs = commitargs or {}
+        self.on_checkpoint = on_checkpoint
+        self.stats = stats or Stats()
+        self.log = log
+        self.writer = ix.writer(**self.writerargs)
+        self.reset()
+
+    def reset(self):
+        """Starts counting towards the next checkpoint"""
+        self.added = 0
+        self.bytes_added = 0
+        self.started = time.time()
+
+    def due(self):
+        """Returns whether a checkpoint should be committed"""
+        return ((self.docs and self.added >= self.docs)
+                or (self.max_bytes and self.bytes_added >= self.max_bytes)
+                or (self.seconds
+                    and time.time() - self.started >= self.seconds))
+
+    def checkpoint(self):
+        """Commits what has been written so far and opens a new writer"""
+        message = "Checkpoint: committing %d documents" % self.added
+        if self.log is not None:
+            self.log(message)
+        else:
+            print message
+        with self.stats.timer('commit'):
+            self.writer.commit(merge=False)
+        if self.on_checkpoint is not None:
+            self.on_checkpoint()
+        self.writer = self.ix.writer(**self.writerargs)
+        self.reset()
+
+    def add_document(self, **fields):
+        self.writer.add_document(**fields)
+        self.added += 1
+        self.bytes_added += sum(len(fields.get(name, u''))
+                                for name in Analyzers.FIELDS.values())
+        if self.due():
+            self.checkpoint()
+
+    def delete_by_term(self, fieldname, text):
+        self.writer.delete_by_term(fieldname, text)
+
+    def commit(self):
+        with self.stats.timer('commit'):
+            self.writer.commit(**self.commitargs)
+
+
+def merge_tiered(writer, segments, tier_size=10, min_docs=1000):
+    """
+    Merge policy for whoosh's commit(mergetype=...) merging segments of
+    similar size. Segments are grouped into tiers by the power of
+    tier_size of their document count, and tier_size segments of the
+    same tier are merged into one of the next tier. A large segment is
+    only rewritten once enough peers of its size exist, unlike whoosh's
+    default policy.
+
+    Returns the segments that are kept as they are.
+    """
+    from whoosh.reading import SegmentReader
+
+    tiers = collections.defaultdict(list)
+    for seg in segments:
+        docs = max(seg.doc_count_all(), min_docs)
+        tiers[int(math.log(docs / float(min_docs), tier_size))].append(seg)
+
+    unchanged = []
+    for tier, segs in tiers.iteritems():
+        if len(segs) < tier_size:
+            unchanged.extend(segs)
+            continue
+        for seg in segs:
+            reader = SegmentReader(writer.storage, writer.schema, seg)
+            writer.add_reader(reader)
+            reader.close()
+    return unchanged
+
+
+#Searchers opened by search_shard in the current pool process
+shard_searchers = {}
+
+
+def search_shard(task):
+    """
+    Runs a query against one shard of the index and returns its hits as
+    (score, path, chunk, chunk_len, docnum) tuples, the stored fields
+    needed to print them, so that stored contents do not go through the
+    pool's pipes for hits that are never highlighted. Runs in the process
+    pool of a ShardedSearcher; each pool process keeps the searchers it
+    opens and refreshes them when their shard changes.
+    """
+    from whoosh.index import open_dir
+    index_dir, query, limit, allow, restrict = task
+    searcher = shard_searchers.get(index_dir)
+    if searcher is None:
+        searcher = open_dir(index_dir).searcher()
+    elif not searcher.up_to_date():
+        searcher = searcher.refresh()
+    shard_searchers[index_dir] = searcher
+
+    results = searcher.search(query, limit=limit, filter=allow,
+                              mask=restrict)
+    return [(hit.score, hit['path'], hit.get('chunk'), hit.get('chunk_len'),
+             hit.docnum) for hit in results]
+
+
+class ShardedSearcher:
+    """
+    Searcher fanning queries out to the shards of an index in a process
+    pool and merging their top hits by score.
+
+    Offers the parts of the whoosh Searcher interface used by
+    DirIndexer.run_search and SearchServer.
+    """
+
+    def __init__(self, shard_dirs, schema, processes=None):
+        """
+        Parameters
+        ----------
+        shard_dirs : list of str
+            The directories of the shards
+        schema : whoosh.fields.Schema
+            The schema shared by the shards
+        processes : int, optional
+            Size of the process pool, defaults to one process per shard
+            up to the number of cores available
+        """
+        import multiprocessing
+        self.shard_dirs = shard_dirs
+        self.schema = schema
+        #Searchers of this process, for the stored contents of hits
+        self.searchers = {}
+        if not processes:
+            processes = min(len(shard_dirs), multiprocessing.cpu_count())
+        #Leave Ctrl+C to the parent, which terminates the pool
+        self.pool = multiprocessing.Pool(
+            processes, signal.signal, (signal.SIGINT, signal.SIG_IGN))
+
+    def search(self, query, terms=False, limit=10, filter=None, mask=None):
+        """Returns the merged ShardedResults of a query"""
+        tasks = [(index_dir, query, limit, filter, mask)
+                 for index_dir in self.shard_dirs]
+        hits = []
+        for shard, shard_hits in enumerate(self.pool.map(search_shard,
+                                                         tasks)):
+            hits.extend((score, shard, path, chunk, chunk_len, docnum)
+                        for score, path, chunk, chunk_len, docnum
+                        in shard_hits)
+
+        if limit is None:
+            hits.sort(key=lambda hit: hit[0], reverse=True)
+        else:
+            hits = heapq.nlargest(limit, hits, key=lambda hit: hit[0])
+        return ShardedResults(self, query, hits)
+
+    def stream(self, query, filter=None, mask=None):
+        """Returns StreamedResults of a query, reading the shards one
+        after the other in this process"""
+        from whoosh.index import open_dir
+        searchers = [open_dir(index_dir).searcher()
+                     for index_dir in self.shard_dirs]
+        return StreamedResults(searchers, self.schema, query, filter, mask,
+                               close=True)
+
+    def stored_fields(self, shard, docnum):
+        """Returns the stored fields of a document of a shard, read in
+        this process"""
+        from whoosh.index import open_dir
+        searcher = self.searchers.get(shard)
+        if searcher is None:
+            searcher = open_dir(self.shard_dirs[shard]).searcher()
+        elif not searcher.up_to_date():
+            searcher = searcher.refresh()
+        self.searchers[shard] = searcher
+        return searcher.stored_fields(docnum)
+
+    def up_to_date(self):
+        #The pool processes refresh their own searchers
+        return True
+
+    def refresh(self):
+        return self
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        for searcher in self.searchers.values():
+            searcher.close()
 
-def start():
 
-    colorama.init()
+class ShardedResults(list):
+    """
+    The merged hits of a ShardedSearcher, as a list of ShardHit. Like
+    whoosh Results, the fragmenter and formatter attributes set how hits
+    are highlighted.
+    """
+
+    def __init__(self, searcher, query, hits):
+        from whoosh import highlight
+        list.__init__(self, [ShardHit(self, score,
+                                      dict(path=path, chunk=chunk,
+                                           chunk_len=chunk_len),
+                                      shard, docnum)
+                             for score, shard, path, chunk, chunk_len, docnum
+                             in hits])
+        self.searcher = searcher
+        self.schema = searcher.schema
+        self.query = query
+        self.fragmenter = highlight.ContextFragmenter()
+        self.formatter = highlight.UppercaseFormatter()
+
+    def __repr__(self):
+        return "<Top %d Results for %r from %d shards>" % (
+            len(self), self.query, len(self.searcher.shard_dirs))
+
+
+class StreamedResults:
+    """
+    The matches of a query in index order and unscored, as ShardHit with
+    a score of None. Matches are read as the results are iterated, so the
+    first can be written before the rest are found. Like whoosh Results,
+    the fragmenter and formatter attributes set how hits are highlighted.
+    """
+
+    def __init__(self, searchers, schema, query, filter=None, mask=None,
+                 close=False):
+        """
+        Parameters
+        ----------
+        searchers : list of whoosh.searching.Searcher
+            The searchers to read matches from, one after the other
+        schema : whoosh.fields.Schema
+            The schema shared by the searchers
+        query : whoosh.query.Query
+            The query to match
+        filter : whoosh.query.Query, optional
+            Only documents also matching this query are kept
+        mask : whoosh.query.Query, optional
+            Documents also matching this query are dropped
+        close : bool, optional
+            Whether to close the searchers once iterated
+        """
+        from whoosh import highlight
+        self.searchers = searchers
+        self.schema = schema
+        self.query = query
+        self.filter = filter
+        self.mask = mask
+        self.close = close
+        self.fragmenter = highlight.ContextFragmenter()
+        self.formatter = highlight.UppercaseFormatter()
+
+    def __iter__(self):
+        try:
+            for searcher in self.searchers:
+                allowed = masked = None
+                if self.filter is not None:
+                    allowed = set(searcher.docs_for_query(self.filter))
+                if self.mask is not None:
+                    masked = set(searcher.docs_for_query(self.mask))
+                for docnum in searcher.docs_for_query(self.query):
+                    if allowed is not None and docnum not in allowed:
+                        continue
+                    if masked is not None and docnum in masked:
+                        continue
+                    yield ShardHit(self, None, searcher.stored_fields(docnum))
+        finally:
+            if self.close:
+                for searcher in self.searchers:
+                    searcher.close()
+
+
+class ShardHit(dict):
+    """The stored fields of a hit from a ShardedSearcher or of a
+    StreamedResults match. The hits of a ShardedSearcher only carry the
+    fields needed to print them; the stored contents are read when asked
+    for, from document docnum of shard"""
+
+    def __init__(self, results, score, fields, shard=None, docnum=None):
+        dict.__init__(self, fields)
+        self.results = results
+        self.score = score
+        self.shard = shard
+        self.docnum = docnum
+
+    def get(self, key, default=None):
+        if key == 'blob' and key not in self and self.docnum is not None:
+            self['blob'] = self.results.searcher.stored_fields(
+                self.shard, self.docnum).get('blob')
+        return dict.get(self, key, default)
+
+    def highlights(self, fieldname, text, top=3):
+        """Returns highlighted snippets of text for the query terms"""
+        from whoosh import highlight
+        terms = set(term for name, term in self.results.query.all_terms()
+                    if name == fieldname)
+        analyzer = self.results.schema[fieldname].analyzer
+        return highlight.highlight(text, terms, analyzer,
+                                   self.results.fragmenter,
+                                   self.results.formatter, top=top)
+
+
+class SearchServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Unix socket server answering searches against a warm searcher.
+
+    Each connection sends one JSON encoded request on a single line and
+    receives the search output until the connection is closed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, di, searcher, cache=None):
+        """
+        Parameters
+        ----------
+        path : str
+            The path of the Unix socket to listen on
+        di : DirIndexer
+            The DirIndexer whose run_search answers the requests
+        searcher : whoosh.searching.Searcher
+            The searcher to query
+        cache : QueryCache, optional
+            The cache of queries and results to answer from
+        """
+        SocketServer.UnixStreamServer.__init__(self, path,
+                                               SearchRequestHandler)
+        self.di = di
+        self.searcher = searcher
+        self.cache = cache
+        self.lock = threading.Lock()
+
+    def search(self, request):
+        """Runs a decoded request and returns its output"""
+        out = StringIO.StringIO()
+        with self.lock:
+            #Pick up commits made since the last query
+            if not self.searcher.up_to_date():
+                self.searcher = self.searcher.refresh()
+            self.di.run_search(self.searcher, out, request['keyword'],
+                               request.get('limit'), request.get('include'),
+                               request.get('exclude'),
+                               request.get('color', False), self.cache,
+                               request.get('offset', 0),
+                               request.get('output', 'text'),
+                               request.get('stream', False),
+                               request.get('substring', False))
+        return out.getvalue()
+
+
+class SearchRequestHandler(SocketServer.StreamRequestHandler):
+    """Handles one search sent by search --server"""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            output = self.server.search(request)
+        except Exception as e:
+            output = u"Error: %s\n" % e
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        self.wfile.write(output)
+
+
+#Defined by color_formatter once whoosh is imported
+ColorFormatter = None
+
+
+def color_formatter(color=True):
+    """
+    Returns a ColorFormatter, which highlights the matched terms of a
+    search with a yellow background if color is set. The class derives
+    from whoosh's Formatter and is defined on first use, so commands
+    that do not highlight never import whoosh.highlight
+    """
+    global ColorFormatter
+    if ColorFormatter is None:
+        import colorama
+        from whoosh import highlight
+
+        class ColorFormatter(highlight.Formatter):
+            """Class that handles colorized search output"""
+
+            def __init__(self, between="\n", color=True):
+                self.between = between
+                self.color = color
+
+            def format_token(self, text, token, replace=False):
+                tokentext = highlight.get_text(text, token, False)
+                if self.color:
+                    return (colorama.Back.YELLOW + tokentext
+                            + colorama.Back.RESET)
+                else:
+                    return tokentext
+
+    return ColorFormatter(color=color)
+
+
+class IndexWriterEventHandler:
+    """
+    Event handler customized for updating a directory with file changes.
+    It has the dispatch method of a watchdog FileSystemEventHandler
+    without deriving from it, so watchdog is only imported by daemon.
+
+    The observer thread only puts events on a bounded queue. A single
+    loop thread takes them off, filters them and coalesces them by path:
+    each path only remembers the latest action it needs, so a file saved
+    many times or the burst of events from a checkout costs one add per
+    final file. A path is written once it has been quiet for the
+    debounce window, in batches of up to batch_size paths, or every
+    delay seconds if fewer are ready. The files of a batch are read by a
+    bounded ReaderPool while the loop writes them.
+
+    When the loop falls behind and the queue fills up, the observer
+    does not block, since watchdog would only queue the events it keeps
+    reading in an unbounded queue of its own. Events wait in an overflow
+    table instead, where repeated events of a path collapse into the
+    latest one, so memory grows with the paths changed rather than with
+    the events. A full batch of pending paths is written without
+    waiting for the delay.
+
+    Changes made while the daemon was stopped are found by a
+    reconciliation thread comparing the stat of every file with the
+    manifest. It feeds a small backlog that the loop only takes from
+    when no live event is waiting, and a path with a live event since
+    the start is left to that event.
+    """
+
+    _STOP = object()
+    _DONE = object()
+
+    def __init__(self, writer, di, all=False,
+                 exclude=[], include=None, delay=5.0, debounce=0.5,
+                 batch_size=1000, queue_size=10000):
+        self.writer = writer
+        self.di = di
+        self.all = all
+        self.exclude = exclude
+        self.include = include
+        self.delay = delay
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.events = Queue.Queue(maxsize=queue_size)
+        #Events that came while the queue was full, newer than those on
+        #it, by (type, path, destination, is directory)
+        self.overflow = collections.OrderedDict()
+        self.overflow_lock = threading.Lock()
+        self.pending = {}   # path -> (action, time of the last event)
+        self.backlog = Queue.Queue(maxsize=batch_size)
+        self.touched = None
+        self.stopping = threading.Event()
+        self.loop = threading.Thread(target=self.run)
+        self.loop.daemon = True
+        self.loop.start()
+
+    def dispatch(self, event):
+        """Hands an event from the observer thread to the loop thread,
+        through self.overflow while the queue is full or the overflow
+        has events left, to keep them in order"""
+        with self.overflow_lock:
+            if not self.overflow:
+                try:
+                    self.events.put_nowait(event)
+                    return
+                except Queue.Full:
+                    pass
+            key = (event.event_type, event.src_path,
+                   getattr(event, 'dest_path', None), event.is_directory)
+            #Moved to the end, so the overflow stays in the order of the
+            #latest event of each key
+            if self.overflow.pop(key, None) is not None:
+                self.di.count('events coalesced')
+            self.overflow[key] = event
+
+    def take_overflow(self, force=False):
+        """Handles the events of the overflow once the queue is empty,
+        or at once if force is set. Called from the loop thread"""
+        with self.overflow_lock:
+            if not self.overflow or not (force or self.events.empty()):
+                return
+            events = self.overflow.values()
+            self.overflow.clear()
+        for event in events:
+            self.handle(event)
+
+    def handle(self, event):
+        """Filters an event and schedules the action it calls for"""
+        #Reread ignore files once they change
+        if os.path.basename(event.src_path) in IgnoreRules.FILENAMES:
+            self.di.ignore_cache.clear()
+        #No handler for the other event types, such as closed
+        action = getattr(self, 'on_' + event.event_type, None)
+        if action is not None:
+            action(event)
+
+    def schedule(self, path, action):
+        """
+        Records the action a path needs, replacing any earlier one
+
+        Parameters
+        ----------
+        path : str
+            The changed path
+        action : {'add', 'delete', 'add_tree', 'delete_tree'}
+            Whether the file, or every file under the directory, has to
+            be (re)indexed or removed
+        """
+        self.pending[path] = (action, time.time())
+        if self.touched is not None:
+            self.touched.add(path)
+
+    def reconcile(self, roots):
+        """
+        Starts the reconciliation of roots with the manifest. Must be
+        called before the observer starts, while nothing writes to the
+        manifest
+        """
+        old = dict(self.di.manifest.entries)
+        self.touched = set()
+        reconciler = threading.Thread(target=self.run_reconcile,
+                                      args=(roots, old))
+        reconciler.daemon = True
+        reconciler.start()
+
+    def run_reconcile(self, roots, old):
+        """
+        Reconciliation thread body: walks the roots and puts the paths
+        changed since the manifest entries old were recorded on the
+        backlog, as (path, action) pairs
+        """
+        #A copy, so taking on the settings of each root does not change
+        #those the loop walks new directories with
+        walker = copy.copy(self.di)
+        for root in roots:
+            if not os.path.isdir(root):
+                print "Not reconciling %s, which is not a directory" % root
+                continue
+            walker.use_root(root)
+            seen = set()
+            for path, st in walker.walk_files(root):
+                seen.add(path)
+                entry = old.get(path)
+                if (entry is None
+                        or Manifest.is_modified(entry, Manifest.entry(st))):
+                    if not self.put_backlog((path, 'add')):
+                        return
+            prefix = os.path.join(root, u'')
+            owner = self.di.roots.find(root)
+            for path in old:
+                if (path.startswith(prefix) and path not in seen
+                        and self.di.roots.find(path) == owner):
+                    if not self.put_backlog((path, 'delete')):
+                        return
+        self.put_backlog(self._DONE)
+
+    def put_backlog(self, item):
+        """Puts an item on the backlog once it has room, returning False
+        if the handler stops first"""
+        while not self.stopping.is_set():
+            try:
+                self.backlog.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def take_backlog(self):
+        """
+        Schedules paths from the reconciliation backlog while no live
+        event waits, up to a batch. Called from the loop thread
+        """
+        while len(self.pending) < self.batch_size and self.events.empty():
+            try:
+                item = self.backlog.get_nowait()
+            except Queue.Empty:
+                return
+            if item is self._DONE:
+                self.touched = None
+                self.di.log("Reconciled the changes made while stopped.")
+                continue
+            path, action = item
+            if path in self.touched or path in self.pending:
+                continue
+            self.di.count('paths reconciled')
+            #Long quiet, so written with the next batch
+            self.pending[path] = (action, 0)
+
+    def take_ready(self, force=False):
+        """
+        Removes and returns the (path, action) pairs that have been quiet
+        for the debounce window, or all of them if force is set. Must be
+        called from the loop thread.
+        """
+        quiet = time.time() - self.debounce
+        ready = [(path, action)
+                 for path, (action, last) in self.pending.iteritems()
+                 if force or last <= quiet]
+        for path, action in ready:
+            del self.pending[path]
+        return ready
+
+    def run(self):
+        """
+        Loop thread body. The daemon does its work on this thread and
+        the reader threads it starts rather than the main one, so these
+        are what daemon --profile profiles
+        """
+        if not self.di.profile:
+            self.process_events()
+            return
+        import cProfile
+        profiler = cProfile.Profile()
+        self.di.profiles = []
+        try:
+            profiler.runcall(self.process_events)
+        finally:
+            self.di.dump_profile(profiler, self.di.profile)
+
+    def process_events(self):
+        """Takes events and backlog paths and writes them in batches
+        until stopped"""
+        last_flush = time.time()
+        wait = max(0.05, min(self.debounce, self.delay))
+        stopping = False
+        while not stopping:
+            #Take the events that arrive within the wait, or until a
+            #batch is pending
+            deadline = time.time() + wait
+            while len(self.pending) < self.batch_size:
+                try:
+                    event = self.events.get(
+                        timeout=max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if event is self._STOP:
+                    stopping = True
+                    break
+                self.handle(event)
+            #The observer has stopped before _STOP is sent, so the
+            #overflow only holds events older than it
+            self.take_overflow(force=stopping)
+            if self.touched is not None:
+                self.take_backlog()
+
+            due = time.time() - last_flush >= self.delay
+            if not (stopping or due
+                    or len(self.pending) >= self.batch_size):
+                continue
+            ready = self.take_ready(force=stopping
+                                    or self.stopping.is_set())
+            for i in range(0, len(ready), self.batch_size):
+                batch = ready[i:i + self.batch_size]
+                #A failed batch must not end the loop, which would leave
+                #the daemon running without indexing anything
+                try:
+                    self.clear_queue(batch)
+                except Exception as e:
+                    print "Could not write %i changes: %s" % (len(batch), e)
+                    self.di.count('failed batches')
+            if ready or due:
+                last_flush = time.time()
+            elif len(self.pending) >= self.batch_size:
+                #A full batch none of which is quiet yet: sleep until the
+                #oldest path is, rather than spin. stop wakes it up
+                oldest = min(last for action, last
+                             in self.pending.itervalues())
+                self.stopping.wait(oldest + self.debounce - time.time())
+
+    def stop(self):
+        """Writes every queued and pending change, ignoring the debounce
+        window, and stops the loop thread. Reconciliation stops where it
+        is, to be done again on the next start"""
+        self.stopping.set()
+        #The queue may be full, so only wait on it for a live loop
+        while self.loop.is_alive():
+            try:
+                self.events.put(self._STOP, timeout=0.1)
+                break
+            except Queue.Full:
+                pass
+        self.loop.join()
+
+    def clear_queue(self, batch):
+        """Applies a batch of (path, action) pairs and commits them."""
+        if not batch:
+            return
+        adds = []
+        for path, action in batch:
+            try:
+                self.apply(path, action, adds)
+            except EnvironmentError as e:
+                print "Could not update %s: %s" % (path, e)
+        self.write_files(adds)
+
+        self.di.log("Commiting %i changes." % len(batch))
+        with self.di.stats.timer('commit'):
+            self.writer.commit()
+        if self.di.manifest is not None:
+            self.di.manifest.save()
+        self.di.log("Done.")
+
+    def apply(self, path, action, adds):
+        """
+        Brings the index up to date with the final state of a path.
+        Removals are written at once while files to (re)index are
+        appended to adds, for write_files
+        """
+        if action == 'delete':
+            self.di.remove_doc(self.writer, path)
+        elif action == 'delete_tree':
+            prefix = os.path.join(path, u'')
+            for indexed_path in [p for p in self.di.manifest.entries
+                                 if p.startswith(prefix)]:
+                self.di.remove_doc(self.writer, indexed_path)
+        elif action == 'add_tree':
+            root = self.di.roots.find(path)
+            if root is not None:
+                self.di.use_root(root)
+            for file_path, st in self.di.walk_files(path):
+                adds.append(file_path)
+        elif not os.path.isfile(path):
+            #Gone or replaced by a directory since the event
+            self.di.remove_doc(self.writer, path)
+        else:
+            adds.append(path)
+
+    def write_files(self, paths):
+        """
+        Reads the files of a batch in a ReaderPool and writes those whose
+        content changed, replacing their old documents, then records
+        every file in the manifest
+        """
+        entries = self.di.manifest.entries
+        paths = list(collections.OrderedDict.fromkeys(paths))
+        items = [(path, entries[path][3] if path in entries else None)
+                 for path in paths]
+        changed = set(path for path in paths if path in entries)
+        x, fingerprints, dropped = self.di.write_changes(self.writer, items,
+                                                         changed)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                #Gone since; its delete event is on the way
+                continue
+            if path in fingerprints:
+                entries[path] = Manifest.entry(st, fingerprints[path])
+            elif path in self.di.unchanged:
+                self.di.log("Unchanged %s" % path)
+                entries[path] = Manifest.entry(st, entries[path][3])
+            else:
+                #Unreadable, or skipped by the binary or size policies
+                entries.pop(path, None)
+        self.di.unchanged.difference_update(paths)
+
+    def path_is_good(self, path, is_dir=False):
+        """
+        Analyzes path according to rules in self.all, self.include,
+        self.exclude, or the settings of the root of the index it is in,
+        and the ignore files and returns whether the path passes.
+        """
+        all, exclude, include = self.all, self.exclude, self.include
+        root = self.di.roots.find(path)
+        if root is not None:
+            settings = self.di.roots.entries[root]
+            all = settings['all']
+            exclude = settings['exclude']
+            include = settings['include']
+
+        if not all:
+            if os.path.basename(path)[0] == '.':
+                return False
+        if self.di.is_ignored(path, is_dir):
+            return False
+        if is_dir:
+            return os.path.basename(path) not in IgnoreRules.VCS_DIRS
+        if exclude:
+            if os.path.splitext(path)[1][1:] in exclude:
+                return False
+        if include:
+            if os.path.splitext(path)[1][1:] not in include:
+                return False
+        return True
+
+    def on_created(self, event):
+        if event.is_directory:
+            if self.path_is_good(event.src_path, True):
+                self.schedule(event.src_path, 'add_tree')
+        elif self.path_is_good(event.src_path):
+            self.schedule(event.src_path, 'add')
+
+    def on_moved(self, event):
+        if event.is_directory:
+            self.schedule(event.src_path, 'delete_tree')
+            if self.path_is_good(event.dest_path, True):
+                self.schedule(event.dest_path, 'add_tree')
+            return
+        self.schedule(event.src_path, 'delete')
+        if self.path_is_good(event.dest_path):
+            self.schedule(event.dest_path, 'add')
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            self.schedule(event.src_path, 'delete_tree')
+        else:
+            self.schedule(event.src_path, 'delete')
+
+    def on_modified(self, event):
+        #Directory mtimes change with their entries, which have events
+        if not event.is_directory and self.path_is_good(event.src_path):
+            self.schedule(event.src_path, 'add')
+
+
+class DuplicateFinder:
+    """
+    Groups paths by content fingerprint in bounded memory. (fingerprint,
+    path) pairs are spilled to partition files by the hash of the
+    fingerprint, so that all the copies of a file land in the same
+    partition, and each partition is then grouped on its own.
+    """
+
+    #Pairs per partition to aim for
+    PARTITION = 200000
+
+    def __init__(self, partitions=1):
+        """
+        Parameters
+        ----------
+        partitions : int
+            Number of partition files
+        """
+        self.dir = tempfile.mkdtemp(prefix="dirindexer-stats-")
+        self.files = [open(os.path.join(self.dir, "%d" % k), 'w')
+                      for k in range(max(partitions, 1))]
+        self.count = 0
+
+    def add(self, fingerprint, path):
+        """Spills a pair to its partition"""
+        k = (zlib.crc32(fingerprint) & 0xffffffff) % len(self.files)
+        self.files[k].write(json.dumps([fingerprint, path]) + "\n")
+
+    def groups(self):
+        """
+        Yields (fingerprint, paths) for every fingerprint shared by
+        several paths, counting them in self.count
+        """
+        for f in self.files:
+            f.close()
+        for f in self.files:
+            paths = collections.defaultdict(list)
+            with open(f.name) as partition:
+                for line in partition:
+                    fingerprint, path = json.loads(line)
+                    paths[fingerprint].append(path)
+            for fingerprint, group in paths.iteritems():
+                if len(group) > 1:
+                    self.count += 1
+                    yield fingerprint, group
+
+    def close(self):
+        """Removes the partition files"""
+        for f in self.files:
+            f.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class Benchmark:
+    """
+    Reproducible benchmark of index, update and search.
+
+    Generates a synthetic tree from a seed, then times an index of it, an
+    update with nothing changed, an update after churning part of the tree
+    and a run of queries. Each workload goes through the same DirIndexer
+    code as the command line, with its output discarded. The number of
+    distinct terms of each content field and the mean number of hits of
+    the queries show what the analyzers cost and what they find. Last,
+    short commands are timed in fresh processes against a startup budget.
+    """
+
+    VOCABULARY = 5000
+
+    def __init__(self, root, files=1000, size_kb=8.0, depth=4,
+                 binary_fraction=0.05, churn=0.1, seed=0, index_args=(),
+                 shards=None, create_args=()):
+        """
+        Parameters
+        ----------
+        root : str
+            Directory to generate the tree and the index in
+        files : int, optional
+            Number of files to generate
+        size_kb : float, optional
+            Mean size of the text files; sizes are log-normal around it
+        depth : int, optional
+            Maximum depth of the directories files are placed in
+        binary_fraction : float, optional
+            Fraction of the files filled with random bytes
+        churn : float, optional
+            Fraction of the files modified, deleted or added before the
+            churned update, in equal parts
+        seed : int, optional
+            Seed of the generator
+        index_args : list of str, optional
+            Extra command line options for index and update
+        shards : int, optional
+            Number of shards to split the index into
+        create_args : list of str, optional
+            Extra command line options for index only, setting up the
+            new index
+        """
+        self.root = root
+        self.tree = os.path.join(root, "tree")
+        self.index_dir = os.path.join(root, ".indexdir")
+        self.files = files
+        self.size_kb = size_kb
+        self.depth = depth
+        self.binary_fraction = binary_fraction
+        self.churn = churn
+        self.seed = seed
+        self.index_args = list(index_args)
+        self.shards = shards
+        self.create_args = list(create_args)
+        self.random = random.Random(seed)
+
+        #Words are drawn with Zipf-like frequencies, like natural text
+        self.words = [self.make_word() for i in range(self.VOCABULARY)]
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, self.VOCABULARY + 1):
+            total += 1.0 / rank
+            self.cumulative.append(total)
+        self.dirs = [self.tree]
+        self.paths = []
+
+    def make_word(self):
+        """Returns a random lowercase word"""
+        return ''.join(chr(self.random.randint(97, 122))
+                       for i in range(self.random.randint(2, 10)))
+
+    def word(self):
+        """Returns a word of the vocabulary, common ones more often"""
+        at = self.random.random() * self.cumulative[-1]
+        return self.words[bisect.bisect(self.cumulative, at)]
+
+    def make_dir(self):
+        """Returns a directory of the tree to put a file in, creating a
+        new one now and then"""
+        parent = self.random.choice(self.dirs)
+        depth = 0
+        if parent != self.tree:
+            depth = os.path.relpath(parent, self.tree).count(os.sep) + 1
+        if depth >= self.depth or self.random.random() < 0.8:
+            return parent
+        path = os.path.join(parent, "d%d" % len(self.dirs))
+        os.mkdir(path)
+        self.dirs.append(path)
+        return path
+
+    def write_file(self, path):
+        """Writes random text, or random bytes for binary files"""
+        if self.random.random() < self.binary_fraction:
+            size = int(self.random.expovariate(1.0 / (self.size_kb * 1024)))
+            data = ('%0*x' % (2 * size, self.random.getrandbits(8 * size))
+                    ).decode('hex') if size else ''
+            with open(path + ".bin", 'wb') as f:
+                f.write(data)
+            return path + ".bin"
+
+        #log-normal sizes with the requested mean
+        sigma = 1.0
+        mu = math.log(self.size_kb * 1024) - sigma * sigma / 2
+        size = int(self.random.lognormvariate(mu, sigma))
+        words = []
+        length = 0
+        while length < size:
+            word = self.word()
+            words.append(word)
+            length += len(word) + 1
+            if self.random.random() < 0.1:
+                words.append('\n')
+        path += self.random.choice([".txt", ".py", ".md", ".c"])
+        if path.endswith((".py", ".c")):
+            words = self.code_words(words)
+        with open(path, 'w') as f:
+            f.write(' '.join(words))
+        return path
+
+    def code_words(self, words):
+        """Joins pairs of words into camelCase and snake_case identifiers
+        and calls, like source code"""
+        code = []
+        for i in range(0, len(words) - 1, 2):
+            first, second = words[i], words[i + 1]
+            if '\n' in (first, second):
+                code += [first, second]
+                continue
+            style = self.random.randint(0, 2)
+            if style == 0:
+                code.append(first + second.capitalize())
+            elif style == 1:
+                code.append(first + '_' + second)
+            else:
+                code.append("%s(%s);" % (first, second))
+        code += words[len(words) - len(words) % 2:]
+        return code
+
+    def generate(self):
+        """Generates the tree"""
+        os.mkdir(self.tree)
+        for i in range(self.files):
+            self.paths.append(self.write_file(
+                os.path.join(self.make_dir(), "f%d" % i)))
+
+    def churn_tree(self):
+        """Modifies, deletes and adds churn/3 of the files each"""
+        n = int(self.files * self.churn / 3)
+        changed = self.random.sample(self.paths, min(2 * n, len(self.paths)))
+        for path in changed[:n]:
+            st = os.stat(path)
+            with open(path, 'ab') as f:
+                f.write(' ' + self.word())
+            #Make sure the change is visible to coarse mtimes
+            os.utime(path, (st.st_atime, st.st_mtime + 1))
+        for path in changed[n:]:
+            os.remove(path)
+            self.paths.remove(path)
+        for i in range(n):
+            self.paths.append(self.write_file(
+                os.path.join(self.make_dir(), "n%d" % i)))
+
+    def run_command(self, argv):
+        """
+        Runs a command line through DirIndexer with its output discarded
+
+        Returns
+        -------
+        result : dict
+            Seconds taken, files and MB read, and the throughputs
+        """
+        args = get_parser().parse_args(argv)
+        di = DirIndexer(args)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        start = time.time()
+        try:
+            args.func(di)
+        finally:
+            elapsed = max(time.time() - start, 1e-6)
+            sys.stdout.close()
+            sys.stdout = stdout
+        mb = di.bytes_read / (1024.0 * 1024.0)
+        return dict(seconds=elapsed, files=di.files_read, mb=mb,
+                    files_per_sec=di.files_read / elapsed,
+                    mb_per_sec=mb / elapsed,
+                    phases=di.stats.as_dict()['times'])
+
+    def substring(self):
+        """Returns a part of three to five letters of a word of the
+        vocabulary"""
+        word = self.word()
+        while len(word) < 4:
+            word = self.word()
+        size = self.random.randint(3, min(5, len(word) - 1))
+        start = self.random.randint(0, len(word) - size)
+        return word[start:start + size]
+
+    def run_queries(self, count, substring=False):
+        """
+        Times count queries of one or two words, or of parts of words
+        with substring set, with the first ten hits of each highlighted
+
+        Returns
+        -------
+        result : dict
+            Number of queries, their latency percentiles in ms and their
+            mean number of hits
+        """
+        di = DirIndexer(get_parser().parse_args(
+            ['search', '', '--index-dir', self.index_dir]))
+        searcher = di.open_searcher()
+        latencies = []
+        try:
+            for i in range(count):
+                if substring:
+                    keyword = self.substring()
+                else:
+                    keyword = self.word()
+                    if self.random.random() < 0.3:
+                        keyword += ' ' + self.word()
+                start = time.time()
+                di.run_search(searcher, StringIO.StringIO(), keyword, 10,
+                              substring=substring)
+                latencies.append((time.time() - start) * 1000)
+        finally:
+            searcher.close()
+
+        latencies.sort()
+        result = dict(queries=count)
+        if count:
+            hits = di.stats.as_dict()['counts'].get('results written', 0)
+            result['mean_hits'] = hits / float(count)
+        for p in (50, 95, 99):
+            result['p%d_ms' % p] = percentile(latencies, p)
+        if latencies:
+            result['mean_ms'] = sum(latencies) / len(latencies)
+        return result
+
+    def index_size(self):
+        """Returns the size of the index in MB"""
+        size = 0
+        for root, dirs, files in os.walk(self.index_dir):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        return size / (1024.0 * 1024.0)
+
+    def term_counts(self):
+        """Returns the number of distinct terms of each content field,
+        summed over the shards"""
+        di = DirIndexer(get_parser().parse_args(
+            ['search', '', '--index-dir', self.index_dir]))
+        from whoosh.index import open_dir
+        counts = collections.Counter()
+        for index_dir in di.get_shard_dirs():
+            reader = open_dir(index_dir).reader()
+            try:
+                for name in list(Analyzers.FIELDS.values()) + ['ngram']:
+                    if name in reader.schema:
+                        counts[name] += sum(1 for term in
+                                            reader.field_terms(name))
+            finally:
+                reader.close()
+        return dict(counts)
+
+    def run_startup(self, runs=5, budget_ms=STARTUP_BUDGET_MS):
+        """
+        Times fresh processes running short commands the way shell
+        integrations do, imports and argument parsing included: --help,
+        a search, and the same search answered from the query cache
+
+        Returns
+        -------
+        result : dict
+            The median milliseconds of each command, the budget, and
+            whether --help and the cached search are within it
+        """
+        import subprocess
+        #Import the module like the console script does, so it is
+        #loaded from its compiled file rather than compiled every time
+        code = ("import sys; sys.path.insert(0, %r); import dirindexer; "
+                "dirindexer.start()" % os.path.dirname(
+                    os.path.abspath(__file__)))
+        search = ['search', self.word(), '--index-dir', self.index_dir,
+                  '-o', 'paths', '-l', '10']
+        commands = dict(help=['--help'], search=search,
+                        cached_search=search + ['--cache'])
+        result = dict(budget_ms=budget_ms)
+        with open(os.devnull, 'w') as devnull:
+            for name, argv in sorted(commands.iteritems()):
+                times = []
+                for i in range(runs + 1):
+                    start = time.time()
+                    subprocess.call([sys.executable, '-c', code] + argv,
+                                    stdout=devnull, stderr=devnull)
+                    times.append((time.time() - start) * 1000)
+                #The first run may compile the module and fill the cache
+                result[name + '_ms'] = percentile(sorted(times[1:]), 50)
+        result['within_budget'] = max(result['help_ms'],
+                                      result['cached_search_ms']) <= budget_ms
+        return result
+
+    def run(self, queries=100, startup_budget_ms=STARTUP_BUDGET_MS):
+        """
+        Runs every workload in self.root
+
+        Returns
+        -------
+        report : dict
+            The parameters, the environment and the results of each
+            workload
+        """
+        import whoosh
+        import multiprocessing
+        if not os.path.exists(self.root):
+            os.mkdir(self.root)
+        start = time.time()
+        self.generate()
+        report = dict(
+            params=dict(files=self.files, size_kb=self.size_kb,
+                        depth=self.depth,
+                        binary_fraction=self.binary_fraction,
+                        churn=self.churn, seed=self.seed,
+                        shards=self.shards,
+                        index_args=self.index_args,
+                        create_args=self.create_args),
+            environment=dict(python=sys.version.split()[0],
+                             whoosh=whoosh.versionstring(),
+                             hash=HASH_NAME,
+                             cpus=multiprocessing.cpu_count()),
+            generate_seconds=time.time() - start)
+
+        shards = ['--shards', str(self.shards)] if self.shards else []
+        index_args = ['--quiet', '--index-dir', self.index_dir]
+        index_args += self.index_args
+        report['index'] = self.run_command(
+            ['index', self.tree] + index_args + shards + self.create_args)
+        report['index_mb'] = self.index_size()
+        report['terms'] = self.term_counts()
+        report['update_noop'] = self.run_command(
+            ['update', self.tree] + index_args)
+        self.churn_tree()
+        report['update_churn'] = self.run_command(
+            ['update', self.tree] + index_args)
+        report['query'] = self.run_queries(queries)
+        if '--ngrams' in self.create_args:
+            report['substring_query'] = self.run_queries(queries,
+                                                         substring=True)
+
+        #ru_maxrss is in KB on Linux; children covers shard workers
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        report['peak_rss_mb'] = peak / 1024.0
+        report['startup'] = self.run_startup(budget_ms=startup_budget_ms)
+        return report
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of sorted values by nearest rank, or
+    None if there are none"""
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def get_parser():
+    """Returns the command line parser of every subcommand"""
 
     parser = argparse.ArgumentParser(
         description='index a directory or search for keywords.')
@@ -456,6 +4440,9 @@ def start():
         'index', help="Index a given directory for future searches")
     parser_index.add_argument('directory', help="the directory to search")
     parser_index.set_defaults(func=DirIndexer.index)
+    parser_index.add_argument("--index-dir",
+                              help="Directory of the index, .indexdir by "
+                                   "default")
     parser_index_filegroup = parser_index.add_mutually_exclusive_group()
     parser_index_filegroup.add_argument(
         "-x", "--exclude", nargs='+',
@@ -465,13 +4452,71 @@ def start():
         help="Include only the specified filetypes in the index")
     parser_index.add_argument("-p", "--processors", type=int,
                               help="Number of processors to utilize")
+    parser_index.add_argument("-r", "--readers", type=int,
+                              help="Number of threads reading files")
+    parser_index.add_argument("--shards", type=int,
+                              help="Number of shards to split a new index "
+                                   "into")
     parser_index.add_argument("-a", "--all", action='store_true',
                               help="Include hidden files and folders in index")
+    parser_index.add_argument("-m", "--max-mb", type=float, default=16.0,
+                              help="Per-file cap in megabytes, 0 for none")
+    parser_index.add_argument("--large-files",
+                              choices=['chunk', 'truncate', 'skip'],
+                              default='chunk',
+                              help="What to do with files over the cap")
+    parser_index.add_argument("--binary",
+                              choices=['skip', 'metadata', 'index'],
+                              default='skip',
+                              help="What to do with binary files")
+    parser_index.add_argument("--store-content", action='store_true',
+                              help="Store compressed file contents for "
+                                   "highlighting results")
+    parser_index.add_argument("--analyzer", nargs='+', metavar="EXT=KIND",
+                              help="Analyze files with this extension as "
+                                   "plain, code or prose text in a new "
+                                   "index")
+    parser_index.add_argument("--ngrams", action='store_true',
+                              help="Keep word n-grams in a new index for "
+                                   "search --substring")
+    parser_index.add_argument("--commit-every", type=int,
+                              help="Commit a checkpoint every N documents")
+    parser_index.add_argument("--commit-mb", type=float,
+                              help="Commit a checkpoint every N MB of "
+                                   "content")
+    parser_index.add_argument("--commit-seconds", type=float,
+                              help="Commit a checkpoint every N seconds")
+    parser_index.add_argument("--merge",
+                              choices=['default', 'none', 'tiered'],
+                              default='default',
+                              help="How to merge segments when committing")
+    parser_index.add_argument("--optimize", action='store_true',
+                              help="Merge the index into one segment when "
+                                   "done")
+    parser_index.add_argument("--no-ignore", action='store_true',
+                              help="Do not read .gitignore and "
+                                   ".dirindexerignore files")
+    parser_index.add_argument("-w", "--walkers", type=int,
+                              help="Number of threads walking top-level "
+                                   "subdirectories")
+    parser_index.add_argument("-q", "--quiet", action='store_true',
+                              help="Do not print every file indexed")
+    parser_index.add_argument("--stats", action='store_true',
+                              help="Print the time spent in each phase")
+    parser_index.add_argument("--profile",
+                              help="Write cProfile output of this process "
+                                   "to this file; the processes writing "
+                                   "the shards are left out")
 
     parser_update = subparsers.add_parser(
         'update', help="Update the index with new or edited files")
-    parser_update.add_argument('directory', help="The directory to update")
+    parser_update.add_argument(
+        'directory', nargs='?',
+        help="The directory to update, every indexed one by default")
     parser_update.set_defaults(func=DirIndexer.update)
+    parser_update.add_argument(
+        "--index-dir",
+        help="Directory of the index, the nearest .indexdir by default")
     parser_update_filegroup = parser_update.add_mutually_exclusive_group()
     parser_update_filegroup.add_argument(
         "-x", "--exclude", nargs='+',
@@ -481,14 +4526,64 @@ def start():
         help="Include only the specified filetypes in the update")
     parser_update.add_argument(
         "-p", "--processors", type=int, help="Number of processors to utilize")
+    parser_update.add_argument(
+        "-r", "--readers", type=int, help="Number of threads reading files")
     parser_update.add_argument(
         "-a", "--all", action='store_true',
         help="Include hidden files and folders in update")
+    parser_update.add_argument(
+        "-m", "--max-mb", type=float, default=16.0,
+        help="Per-file cap in megabytes, 0 for none")
+    parser_update.add_argument(
+        "--large-files", choices=['chunk', 'truncate', 'skip'],
+        default='chunk', help="What to do with files over the cap")
+    parser_update.add_argument(
+        "--binary", choices=['skip', 'metadata', 'index'],
+        default='skip', help="What to do with binary files")
+    parser_update.add_argument(
+        "--store-content", action='store_true',
+        help="Store compressed file contents for highlighting results")
+    parser_update.add_argument(
+        "--commit-every", type=int,
+        help="Commit a checkpoint every N documents")
+    parser_update.add_argument(
+        "--commit-mb", type=float,
+        help="Commit a checkpoint every N MB of content")
+    parser_update.add_argument(
+        "--commit-seconds", type=float,
+        help="Commit a checkpoint every N seconds")
+    parser_update.add_argument(
+        "--merge", choices=['default', 'none', 'tiered'], default='default',
+        help="How to merge segments when committing")
+    parser_update.add_argument(
+        "--optimize", action='store_true',
+        help="Merge the index into one segment when done")
+    parser_update.add_argument(
+        "--no-ignore", action='store_true',
+        help="Do not read .gitignore and .dirindexerignore files")
+    parser_update.add_argument(
+        "-w", "--walkers", type=int,
+        help="Number of threads walking top-level subdirectories")
+    parser_update.add_argument(
+        "-q", "--quiet", action='store_true',
+        help="Do not print every file updated")
+    parser_update.add_argument(
+        "--stats", action='store_true',
+        help="Print the time spent in each phase")
+    parser_update.add_argument(
+        "--profile",
+        help="Write cProfile output of this process to this file; the "
+             "processes writing the shards are left out")
 
     parser_daemon = subparsers.add_parser(
         'daemon', help="Start a daemon to automatically update the index.")
-    parser_daemon.add_argument('directory', help="The directory to watch.")
+    parser_daemon.add_argument(
+        'directory', nargs='?',
+        help="The directory to watch, every indexed one by default.")
     parser_daemon.set_defaults(func=DirIndexer.daemon)
+    parser_daemon.add_argument(
+        "--index-dir",
+        help="Directory of the index, the nearest .indexdir by default")
     parser_daemon_filegroup = parser_daemon.add_mutually_exclusive_group()
     parser_daemon_filegroup.add_argument(
         "-x", "--exclude", nargs='+',
@@ -504,6 +4599,55 @@ def start():
     parser_daemon.add_argument(
         "-d", "--delay", type=float,
         help="Delay in between commits")
+    parser_daemon.add_argument(
+        "--debounce", type=float, default=0.5,
+        help="Seconds a file has to stay unchanged before it is indexed")
+    parser_daemon.add_argument(
+        "-b", "--batch-size", type=int, default=1000,
+        help="Number of changed files that triggers an early commit")
+    parser_daemon.add_argument(
+        "-r", "--readers", type=int,
+        help="Number of threads reading changed files")
+    parser_daemon.add_argument(
+        "--no-reconcile", action='store_true',
+        help="Do not look for changes made while the daemon was stopped")
+    parser_daemon.add_argument(
+        "--queue-size", type=int, default=10000,
+        help="Number of events that may wait to be handled before "
+             "repeated events of a path are coalesced")
+    parser_daemon.add_argument(
+        "-m", "--max-mb", type=float, default=16.0,
+        help="Per-file cap in megabytes, 0 for none")
+    parser_daemon.add_argument(
+        "--large-files", choices=['chunk', 'truncate', 'skip'],
+        default='chunk', help="What to do with files over the cap")
+    parser_daemon.add_argument(
+        "--binary", choices=['skip', 'metadata', 'index'],
+        default='skip', help="What to do with binary files")
+    parser_daemon.add_argument(
+        "--store-content", action='store_true',
+        help="Store compressed file contents for highlighting results")
+    parser_daemon.add_argument(
+        "--merge", choices=['default', 'none', 'tiered'], default='default',
+        help="How to merge segments when committing")
+    parser_daemon.add_argument(
+        "--no-ignore", action='store_true',
+        help="Do not read .gitignore and .dirindexerignore files")
+    parser_daemon.add_argument(
+        "-q", "--quiet", action='store_true',
+        help="Do not print every file updated")
+    parser_daemon.add_argument(
+        "--stats", action='store_true',
+        help="Print a stats line every --stats-interval seconds")
+    parser_daemon.add_argument(
+        "--stats-interval", type=float, default=60.0,
+        help="Seconds between stats lines and metrics file updates")
+    parser_daemon.add_argument(
+        "--metrics", help="Keep the counters in this file as JSON")
+    parser_daemon.add_argument(
+        "--profile",
+        help="Write cProfile output of the threads writing the index to "
+             "this file; the processes writing the shards are left out")
 
     parser_search = subparsers.add_parser(
         'search', help="Search the indexed directory for a keyword")
@@ -517,6 +4661,27 @@ def start():
         '-l', '--limit', type=int,
         default=None,
         help='Number of results to show; passing None will show all')
+    parser_search_pagegroup = parser_search.add_mutually_exclusive_group()
+    parser_search_pagegroup.add_argument(
+        '--offset', type=int, default=0,
+        help="Number of leading results to skip")
+    parser_search_pagegroup.add_argument(
+        '--page', type=int,
+        help="Show this page of results, pages being --limit results "
+             "long, 10 by default")
+    parser_search.add_argument(
+        '-o', '--output', choices=['text', 'paths', 'jsonl'],
+        default='text',
+        help="Print results with highlighted snippets, only their paths, "
+             "or as JSON lines")
+    parser_search.add_argument(
+        '--stream', action='store_true',
+        help="Print results as they are found, unranked, instead of "
+             "ranking every match first")
+    parser_search.add_argument(
+        '--substring', action='store_true',
+        help="Match the keyword inside words; needs an index created "
+             "with --ngrams")
     parser_search_filegroup = parser_search.add_mutually_exclusive_group()
     parser_search_filegroup.add_argument(
         '-x', "--exclude", nargs='+',
@@ -524,16 +4689,147 @@ def start():
     parser_search_filegroup.add_argument(
         '-i', "--include", nargs='+',
         help="Include only the specified filetypes in the search")
+    parser_search.add_argument(
+        '-s', '--server', nargs='?', const='',
+        help="Ask a running serve process listening on this socket, "
+             "search.sock in the index by default")
+    parser_search.add_argument(
+        "--index-dir",
+        help="Directory of the index, the nearest .indexdir by default")
+    parser_search.add_argument(
+        '--stats', action='store_true',
+        help="Print the time spent in each phase to stderr")
+    parser_search.add_argument(
+        '--cache', action='store_true',
+        help="Use the query cache kept in the index directory")
+    parser_search.add_argument(
+        '--cache-mb', type=float, default=16.0,
+        help="Size of the query cache in MB")
+    parser_search.add_argument(
+        '--profile', help="Write cProfile output to this file")
+
+    parser_serve = subparsers.add_parser(
+        'serve', help="Keep the index open and answer searches on a socket")
+    parser_serve.set_defaults(func=DirIndexer.serve)
+    parser_serve.add_argument(
+        '-s', '--socket',
+        help="The Unix socket to listen on, search.sock in the index by "
+             "default")
+    parser_serve.add_argument(
+        "--index-dir",
+        help="Directory of the index, the nearest .indexdir by default")
+    parser_serve.add_argument(
+        '--cache-mb', type=float, default=16.0,
+        help="Size of the query cache in MB, 0 to disable it")
+    parser_serve.add_argument(
+        '--persist-cache', action='store_true',
+        help="Keep the query cache in the index directory across "
+             "restarts")
+    parser_serve.add_argument(
+        '--stats', action='store_true',
+        help="Print the counters, including cache hits, on exit")
+
+    parser_bench = subparsers.add_parser(
+        'bench', help="Benchmark indexing, updating and searching a "
+                      "synthetic tree")
+    parser_bench.set_defaults(func=DirIndexer.bench)
+    parser_bench.add_argument(
+        '-n', '--files', type=int, default=1000,
+        help="Number of files to generate")
+    parser_bench.add_argument(
+        '--size-kb', type=float, default=8.0,
+        help="Mean size of the text files in KB")
+    parser_bench.add_argument(
+        '--depth', type=int, default=4,
+        help="Maximum directory depth")
+    parser_bench.add_argument(
+        '--binary-fraction', type=float, default=0.05,
+        help="Fraction of binary files")
+    parser_bench.add_argument(
+        '--churn', type=float, default=0.1,
+        help="Fraction of files changed before the second update")
+    parser_bench.add_argument(
+        '-q', '--queries', type=int, default=200,
+        help="Number of queries to time")
+    parser_bench.add_argument(
+        '--seed', type=int, default=0,
+        help="Seed of the synthetic tree and queries")
+    parser_bench.add_argument(
+        '--dir',
+        help="Empty directory to run in and keep, instead of a temporary "
+             "one")
+    parser_bench.add_argument(
+        '-o', '--output', help="Write the JSON report to this file")
+    parser_bench.add_argument(
+        "-p", "--processors", type=int, help="Number of processors to utilize")
+    parser_bench.add_argument(
+        "-r", "--readers", type=int, help="Number of threads reading files")
+    parser_bench.add_argument(
+        "--shards", type=int, help="Number of shards to split the index into")
+    parser_bench.add_argument(
+        "--store-content", action='store_true',
+        help="Store compressed file contents in the index")
+    parser_bench.add_argument(
+        "--analyzer", nargs='+', metavar="EXT=KIND",
+        help="Analyze files with this extension as plain, code or prose "
+             "text")
+    parser_bench.add_argument(
+        "--ngrams", action='store_true',
+        help="Keep word n-grams and time substring queries too")
+    parser_bench.add_argument(
+        "--startup-budget-ms", type=float, default=STARTUP_BUDGET_MS,
+        help="Milliseconds --help and a cached search may take to run")
+
+    parser_stats = subparsers.add_parser(
+        'stats', help="Report the size of the index and where it comes "
+                      "from, without reading the indexed files")
+    parser_stats.set_defaults(func=DirIndexer.index_stats)
+    parser_stats.add_argument(
+        "--index-dir",
+        help="Directory of the index, the nearest .indexdir by default")
+    parser_stats.add_argument(
+        '-n', '--top', type=int, default=10,
+        help="Number of terms, extensions and duplicate groups to list")
+    parser_stats.add_argument(
+        '--sample', type=int, default=0,
+        help="Stat this many indexed files to estimate the stale ones")
+    parser_stats.add_argument(
+        '--manifest', action='store_true',
+        help="Also compare the index with its manifest, which is loaded "
+             "whole: memory then grows with the number of files")
+    parser_stats.add_argument(
+        '--json', action='store_true',
+        help="Print the report as JSON")
 
     parser_clear = subparsers.add_parser(
         "clear", help="Delete the current index.")
     parser_clear.set_defaults(func=DirIndexer.clear)
+    parser_clear.add_argument(
+        "--index-dir", help="Directory of the index, .indexdir by default")
+
+    return parser
+
 
-    args = parser.parse_args()
+def start():
+
+    args = get_parser().parse_args()
+    if args.func == DirIndexer.search:
+        import colorama
+        colorama.init()
 
     di = DirIndexer(args)
 
-    args.func(di)
+    #The daemon profiles its own loop thread
+    if getattr(args, 'profile', None) and args.func != DirIndexer.daemon:
+        import cProfile
+        profiler = cProfile.Profile()
+        di.profiles = []
+        try:
+            profiler.runcall(args.func, di)
+        finally:
+            di.dump_profile(profiler, args.profile)
+    else:
+        args.func(di)
 
 if __name__ == '__main__':
     start()
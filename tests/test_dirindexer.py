@@ -0,0 +1,136 @@
+"""
+Tests of the pure parts of dirindexer: the translation of ignore file
+rules and the cutting of large files into chunks. Run with
+
+    python2 -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("dirindexer runs on Python 2")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+import dirindexer
+from dirindexer import IgnoreRules
+
+
+class IgnoreRulesTest(unittest.TestCase):
+
+    base = os.path.join(os.sep, 'repo')
+
+    def ignored(self, lines, rel, is_dir=False):
+        rules = IgnoreRules(self.base, lines)
+        return IgnoreRules.ignored([rules], os.path.join(self.base, rel),
+                                   is_dir)
+
+    def test_name_matches_at_any_depth(self):
+        self.assertTrue(self.ignored(['*.log'], 'a.log'))
+        self.assertTrue(self.ignored(['*.log'], 'x/y/a.log'))
+        self.assertFalse(self.ignored(['*.log'], 'a.txt'))
+
+    def test_star_does_not_cross_directories(self):
+        self.assertTrue(self.ignored(['src/*.c'], 'src/a.c'))
+        self.assertFalse(self.ignored(['src/*.c'], 'src/x/a.c'))
+
+    def test_anchored(self):
+        self.assertTrue(self.ignored(['/build'], 'build', True))
+        self.assertFalse(self.ignored(['/build'], 'x/build', True))
+        self.assertTrue(self.ignored(['doc/out'], 'doc/out'))
+        self.assertFalse(self.ignored(['doc/out'], 'x/doc/out'))
+
+    def test_double_star(self):
+        self.assertTrue(self.ignored(['**/tmp'], 'tmp', True))
+        self.assertTrue(self.ignored(['**/tmp'], 'a/b/tmp', True))
+        self.assertTrue(self.ignored(['a/**/z'], 'a/z'))
+        self.assertTrue(self.ignored(['a/**/z'], 'a/b/c/z'))
+        self.assertTrue(self.ignored(['out/**'], 'out/a/b.txt'))
+        self.assertFalse(self.ignored(['out/**'], 'out', True))
+
+    def test_dir_only(self):
+        self.assertTrue(self.ignored(['cache/'], 'cache', True))
+        self.assertTrue(self.ignored(['cache/'], 'x/cache', True))
+        self.assertFalse(self.ignored(['cache/'], 'cache', False))
+
+    def test_negation(self):
+        lines = ['*.log', '!keep.log']
+        self.assertTrue(self.ignored(lines, 'a.log'))
+        self.assertFalse(self.ignored(lines, 'keep.log'))
+        #A later rule wins
+        self.assertTrue(self.ignored(['!keep.log', '*.log'], 'keep.log'))
+
+    def test_deeper_rules_win(self):
+        outer = IgnoreRules(self.base, ['*.log'])
+        inner = IgnoreRules(os.path.join(self.base, 'sub'), ['!*.log'])
+        path = os.path.join(self.base, 'sub', 'a.log')
+        self.assertFalse(IgnoreRules.ignored([outer, inner], path, False))
+        self.assertTrue(IgnoreRules.ignored([outer], path, False))
+
+    def test_comments_escapes_and_classes(self):
+        self.assertEqual(IgnoreRules(self.base, ['# x', '', '  ']).rules, [])
+        self.assertTrue(self.ignored(['\\#notes'], '#notes'))
+        self.assertTrue(self.ignored(['\\!bang'], '!bang'))
+        self.assertTrue(self.ignored(['a?.txt'], 'ab.txt'))
+        self.assertFalse(self.ignored(['a?.txt'], 'a/.txt'))
+        self.assertTrue(self.ignored(['[ab].txt'], 'b.txt'))
+        self.assertFalse(self.ignored(['[!ab].txt'], 'b.txt'))
+        self.assertTrue(self.ignored(['[!ab].txt'], 'c.txt'))
+
+
+class ChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="dirindexer-test-")
+        self.path = os.path.join(self.dir, 'log.txt')
+        args = dirindexer.get_parser().parse_args(
+            ['index', self.dir, '--max-mb', '0.001', '-q',
+             '--index-dir', os.path.join(self.dir, '.indexdir')])
+        self.di = dirindexer.DirIndexer(args)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_chunks(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        return [fields for fields, size in self.di.read_docs(self.path)]
+
+    def test_chunks_cover_the_bytes_of_the_file(self):
+        #Invalid UTF-8 dropped on decoding must not shift offsets
+        data = ''.join('tok%d %s' % (i, '\xff\xfe' if i % 7 == 0 else '')
+                       for i in range(2000)) + 'caf\xc3\xa9 end'
+        chunks = self.read_chunks(data)
+        self.assertTrue(len(chunks) > 1)
+        offset = 0
+        for chunk in chunks:
+            self.assertEqual(chunk['chunk'], offset)
+            offset += chunk['chunk_len']
+        self.assertEqual(offset, len(data))
+
+        field = self.di.get_analyzers().field('txt')
+        for chunk in chunks:
+            raw = data[chunk['chunk']:chunk['chunk'] + chunk['chunk_len']]
+            self.assertEqual(chunk[field], raw.decode('utf-8', 'ignore'))
+        self.assertTrue(chunks[-1][field].endswith(u'caf\xe9 end'))
+
+    def test_last_chunk_holds_the_tail_and_the_fingerprint(self):
+        chunks = self.read_chunks('word ' * 1000)
+        field = self.di.get_analyzers().field('txt')
+        self.assertTrue(chunks[-1][field].strip())
+        self.assertEqual(['fingerprint' in chunk for chunk in chunks],
+                         [False] * (len(chunks) - 1) + [True])
+
+    def test_words_are_not_split(self):
+        words = ['word%d' % i for i in range(1500)]
+        chunks = self.read_chunks(' '.join(words))
+        field = self.di.get_analyzers().field('txt')
+        found = [word for chunk in chunks for word in chunk[field].split()]
+        self.assertEqual(found, words)
+
+
+if __name__ == '__main__':
+    unittest.main()